@@ -0,0 +1,146 @@
+"""Benchmark cluster allocation on a fragmented volume.
+
+Fills a synthetic volume with files of random sizes, frees a random half of
+them, then allocates new files (some grown in several steps) with the free
+runs index in `FATtools.fatalloc` and with the dictionary map that `FAT.alloc`
+and `exFAT.Bitmap.alloc` used before, which was popped in insertion order and
+compacted by repeated full sorts. Reports allocation time and the fragments
+of the new files.
+
+Usage: uv run python benchmarks/bench_alloc.py [--clusters N] [--files N]
+"""
+
+import argparse
+import copy
+import random
+import time
+
+from chi_edge.vendor.FATtools import fatalloc
+
+
+class LegacyMap:
+    """The previous free space map: {first_cluster: run_length}."""
+
+    def __init__(self, runs):
+        self.map = dict(runs)
+        self.flag = 1
+
+    def compact(self):
+        if not self.flag:
+            return
+        while 1:
+            d = copy.copy(self.map)
+            for k, v in sorted(self.map.items()):
+                while d.get(k + v):
+                    v1 = d.get(k + v)
+                    d[k] = v + v1
+                    del d[k + v]
+                    v += v1
+            if self.map != d:
+                self.map = d
+                continue
+            break
+        self.flag = 0
+
+    def alloc(self, runs_map, count):
+        self.compact()
+        while count:
+            last_run = list(runs_map.items())[-1] if runs_map else None
+            i, n = self.map.popitem()
+            if n > count:
+                self.map[i + count] = n - count
+            n = min(n, count)
+            if last_run and i == last_run[0] + last_run[1]:
+                runs_map[last_run[0]] = n + last_run[1]
+            else:
+                runs_map[i] = n
+            count -= n
+
+    def free(self, runs_map):
+        self.flag = 1
+        self.map.update(runs_map)
+
+
+class ExtentsMap:
+    """The same operations as `FAT.alloc` and `FAT.free` on `FreeExtents`."""
+
+    def __init__(self, runs, fit):
+        self.map = fatalloc.FreeExtents(runs)
+        self.fit = fit
+        self.last = 2
+
+    def alloc(self, runs_map, count):
+        last_run = next(reversed(runs_map.items())) if runs_map else None
+        while count:
+            prefer = last_run and last_run[0] + last_run[1]
+            i = self.map.find(count, prefer, self.fit, self.last)
+            n = self.map.take(i, count)
+            if last_run and i == prefer:
+                last_run = (last_run[0], n + last_run[1])
+            else:
+                last_run = (i, n)
+            runs_map[last_run[0]] = last_run[1]
+            self.last = i + n - 1
+            count -= n
+
+    def free(self, runs_map):
+        for start, length in runs_map.items():
+            self.map.add(start, length)
+
+
+def fragmented_volume(clusters, files, rng):
+    """Free runs left by writing `files` files back to back and erasing half."""
+    sizes = [rng.randint(1, 2 * clusters // files) for _ in range(files)]
+    runs, pos = [], 2
+    for size in sizes:
+        if pos + size > clusters + 2:
+            break
+        if rng.random() < 0.5:
+            runs.append((pos, size))
+        pos += size
+    runs.append((pos, clusters + 2 - pos))
+    return runs
+
+
+def workload(allocator, requests, rng):
+    """Allocates files, growing some of them in steps and erasing a few."""
+    files = []
+    start = time.perf_counter()
+    for count, steps in requests:
+        runs_map = {}
+        for _ in range(steps):
+            allocator.alloc(runs_map, count // steps)
+        files.append(runs_map)
+        if rng.random() < 0.1:
+            allocator.free(files.pop(rng.randrange(len(files))))
+    elapsed = time.perf_counter() - start
+    fragments = [len(runs_map) for runs_map in files]
+    return elapsed, sum(fragments) / len(fragments), max(fragments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clusters", type=int, default=1 << 20)
+    parser.add_argument("--files", type=int, default=20000)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    runs = fragmented_volume(args.clusters, args.files, rng)
+    free = sum(n for _, n in runs)
+    requests = []
+    while sum(c for c, _ in requests) < free // 2:
+        steps = rng.choice((1, 1, 1, 4))
+        requests.append((rng.randint(1, 64) * steps, steps))
+    print(f"{len(runs)} free runs, {free} free clusters, {len(requests)} new files")
+
+    print(f"{'allocator':<16}{'time (s)':>10}{'avg frags':>11}{'max frags':>11}")
+    for name, make in (
+        ("legacy", lambda: LegacyMap(runs)),
+        ("best fit", lambda: ExtentsMap(runs, fatalloc.BEST_FIT)),
+        ("next fit", lambda: ExtentsMap(runs, fatalloc.NEXT_FIT)),
+    ):
+        elapsed, avg, top = workload(make(), requests, random.Random(7))
+        print(f"{name:<16}{elapsed:>10.3f}{avg:>11.2f}{top:>11}")
+
+
+if __name__ == "__main__":
+    main()
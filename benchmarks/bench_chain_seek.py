@@ -0,0 +1,131 @@
+"""Benchmark cluster chain I/O on a fragmented file.
+
+Times random reads and a sequential read through `FATtools.FAT.Chain` over a
+chain whose runs are all one or two clusters long, comparing the bisect VCN
+index with the linear run scans that `seek` and `maxrun4len` used before.
+
+Usage: uv run python benchmarks/bench_chain_seek.py [--runs N]
+"""
+
+import argparse
+import io
+import random
+import time
+from collections import OrderedDict
+
+from chi_edge.vendor.FATtools import FAT
+
+CLUSTER = 512
+
+
+class RamBoot:
+    """Just enough of a boot sector for `Chain`: clusters live in a BytesIO."""
+
+    cluster = CLUSTER
+
+    def __init__(self, clusters):
+        self.stream = io.BytesIO(bytes(range(256)) * (clusters * CLUSTER // 256))
+
+    def cl2offset(self, cluster):
+        return (cluster - 2) * CLUSTER
+
+
+class RamFAT:
+    last = 0x0FFFFFFF
+    exfat = False
+
+
+class LegacyChain(FAT.Chain):
+    """Chain with the previous linear run lookups."""
+
+    def maxrun4len(self, length):
+        n = (length + self.boot.cluster - 1) // self.boot.cluster
+        items = list(self.runs.items())
+        for start, count in items:
+            if start <= self.lastvlcn[1] < start + count:
+                break
+        left = start + count - self.lastvlcn[1]
+        run = min(n, left)
+        if n < left:
+            nxt = self.lastvlcn[1] + n
+        elif items.index((start, count)) == len(items) - 1:
+            nxt = self.fat.last
+        else:
+            nxt = items[items.index((start, count)) + 1][0]
+        self.lastvlcn = (self.lastvlcn[0] + run, nxt)
+        return run * self.boot.cluster
+
+    def seek(self, offset, whence=0):
+        self.pos = offset
+        self.vcn = offset // self.boot.cluster
+        self.vco = offset % self.boot.cluster
+        vcn = 0
+        for start, count in list(self.runs.items()):
+            if vcn <= self.vcn < vcn + count:
+                lcn = start + self.vcn - vcn
+                self.stream.seek(self.boot.cl2offset(lcn) + self.vco)
+                self.lastvlcn = (self.vcn, lcn)
+                return
+            vcn += count
+
+
+def fragmented_chain(cls, runs, rng):
+    """A chain of `runs` runs of 1-2 clusters, separated by used clusters."""
+    boot = RamBoot(3 * runs + 2)
+    chain = cls(boot, RamFAT(), 0)
+    lcn = 2
+    for _ in range(runs):
+        length = rng.randint(1, 2)
+        chain.runs[lcn] = length
+        lcn += length + 1
+    chain.runs = OrderedDict(chain.runs)
+    chain._sync_index()
+    chain.start = next(iter(chain.runs))
+    chain.size = chain.filesize = sum(chain.runs.values()) * CLUSTER
+    chain.lastvlcn = (0, chain.start)
+    return chain
+
+
+def random_reads(chain, offsets):
+    out = []
+    for pos in offsets:
+        chain.seek(pos)
+        out.append(chain.read(3 * CLUSTER))
+    return out
+
+
+def sequential_read(chain):
+    chain.seek(0)
+    return chain.read(chain.filesize)
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5000, help="runs in the chain")
+    parser.add_argument("--reads", type=int, default=500, help="random reads")
+    args = parser.parse_args()
+
+    new = fragmented_chain(FAT.Chain, args.runs, random.Random(1))
+    old = fragmented_chain(LegacyChain, args.runs, random.Random(1))
+    rng = random.Random(2)
+    offsets = [rng.randrange(new.filesize - 3 * CLUSTER) for _ in range(args.reads)]
+
+    print(f"{'case':<28}{'legacy (s)':>12}{'index (s)':>12}{'speedup':>10}")
+    for name, func, extra in (
+        (f"{args.reads} random reads", random_reads, (offsets,)),
+        ("sequential read", sequential_read, ()),
+    ):
+        t_old, r_old = timeit(func, old, *extra)
+        t_new, r_new = timeit(func, new, *extra)
+        assert r_old == r_new, f"{name} mismatch"
+        print(f"{name:<28}{t_old:>12.3f}{t_new:>12.4f}{t_old / t_new:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
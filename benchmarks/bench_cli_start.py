@@ -0,0 +1,49 @@
+"""Benchmark the CLI cold start.
+
+Times fresh interpreters running a bare `python -c pass`, `import chi_edge.cli`,
+`chi-edge --help` and `chi-edge device bake --help`, and, for comparison,
+importing the heavy dependencies the CLI loads only in the commands using
+them.
+
+Usage: uv run python benchmarks/bench_cli_start.py [--runs N]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+CASES = (
+    ("interpreter", "pass"),
+    ("import chi_edge.cli", "import chi_edge.cli"),
+    ("chi-edge --help", "from chi_edge.cli import cli; cli(['--help'])"),
+    (
+        "chi-edge device bake --help",
+        "from chi_edge.cli import cli; cli(['device', 'bake', '--help'])",
+    ),
+    ("import openstack, rich, yaml", "import openstack, rich.console, yaml"),
+)
+
+
+def timed(code, runs):
+    """Median wall time, in milliseconds, of a fresh interpreter running `code`."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="runs of each case")
+    args = parser.parse_args()
+    print(f"{'case':<32}{'ms':>8}")
+    for label, code in CASES:
+        print(f"{label:<32}{timed(code, args.runs):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Benchmark FAT/exFAT free space scanning.
+
+Compares the bulk scanners in `FATtools.fatscan` with the per-slot Python loops
+that `FAT.map_free_space` and `exFAT.Bitmap.map_free_space` used before, on
+synthetic FAT pages and allocation bitmaps.
+
+Usage: uv run python benchmarks/bench_free_scan.py [--mib N]
+"""
+
+import argparse
+import random
+import time
+
+from chi_edge.vendor.FATtools import fatscan
+
+
+def legacy_fat_runs(s, bits, first=0):
+    """Per-slot loop equivalent to the previous FAT16/32 map_free_space."""
+    runs = []
+    size = bits // 8
+    j = 0
+    while j < len(s):
+        first_free = -1
+        run_length = -1
+        while j < len(s):
+            if any(s[j + k] for k in range(size)):
+                j += size
+                if run_length > 0:
+                    break
+                continue
+            if first_free < 0:
+                first_free = first + j // size
+                run_length = 0
+            run_length += 1
+            j += size
+        if first_free < 0:
+            continue
+        runs.append((first_free, run_length))
+    return runs
+
+
+def legacy_bitmap_runs(s, first=0):
+    """Per-bit loop equivalent to the previous exFAT Bitmap.map_free_space."""
+    runs = []
+    j = 0
+    while j < len(s) * 8:
+        first_free = -1
+        run_length = -1
+        while j < len(s) * 8:
+            if not j % 8 and s[j // 8] == 0xFF:
+                if run_length > 0:
+                    break
+                j += 8
+                continue
+            if s[j // 8] & (1 << (j % 8)):
+                if run_length > 0:
+                    break
+                j += 1
+                continue
+            if first_free < 0:
+                first_free = first + j
+                run_length = 0
+            run_length += 1
+            j += 1
+        if first_free < 0:
+            continue
+        runs.append((first_free, run_length))
+    return runs
+
+
+def synthetic_fat(slots, bits, used, rng):
+    """A FAT page where `used` of the slots hold chains of random length."""
+    size = bits // 8
+    last = (1 << bits) - 1
+    out = bytearray(slots * size)
+    i = 0
+    while i < slots:
+        run = rng.randint(1, 64)
+        if rng.random() < used:
+            for k in range(i, min(i + run, slots)):
+                value = (k + 3) % (last - 16) if k + 1 < i + run else last
+                out[k * size : (k + 1) * size] = value.to_bytes(size, "little")
+        i += run
+    return bytes(out)
+
+
+def synthetic_bitmap(nbytes, used, rng):
+    out = bytearray(nbytes)
+    i = 0
+    while i < nbytes * 8:
+        run = rng.randint(1, 512)
+        if rng.random() < used:
+            for k in range(i, min(i + run, nbytes * 8)):
+                out[k // 8] |= 1 << (k % 8)
+        i += run
+    return bytes(out)
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mib", type=float, default=1, help="page size in MiB")
+    args = parser.parse_args()
+    nbytes = int(args.mib * (1 << 20))
+    rng = random.Random(42)
+
+    print(f"{'case':<28}{'legacy (s)':>12}{'bulk (s)':>12}{'speedup':>10}")
+    for used in (0.1, 0.5, 0.9):
+        for bits in (16, 32):
+            page = synthetic_fat(nbytes * 8 // bits, bits, used, rng)
+            t_old, old = timeit(legacy_fat_runs, page, bits)
+            t_new, new = timeit(fatscan.fat_free_runs, page, bits)
+            assert old == new, f"FAT{bits} mismatch"
+            name = f"FAT{bits} {int(used * 100)}% used"
+            print(f"{name:<28}{t_old:>12.3f}{t_new:>12.4f}{t_old / t_new:>9.0f}x")
+        bitmap = synthetic_bitmap(nbytes // 8, used, rng)
+        t_old, old = timeit(legacy_bitmap_runs, bitmap)
+        t_new, new = timeit(fatscan.bitmap_free_runs, bitmap)
+        assert old == new, "bitmap mismatch"
+        name = f"exFAT bitmap {int(used * 100)}% used"
+        print(f"{name:<28}{t_old:>12.3f}{t_new:>12.4f}{t_old / t_new:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark the memory mapped disk backend.
+
+Times `Volume.openvolume` followed by reading back a file from the boot
+partition of a synthetic balenaOS-like image, through the cached `disk.disk`
+backend and through `disk.mmap_disk` (`Volume.vopen(..., mapped=True)`).
+
+Usage: uv run python benchmarks/bench_mmap_disk.py [--mib N] [--rounds N]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from chi_edge.vendor.FATtools import Volume
+from tests.fatimage import make_disk_image
+
+
+def open_and_read(path, name, mapped, chunk):
+    part = Volume.vopen(path, "rb", "partition0", mapped=mapped)
+    fs = Volume.openvolume(part)
+    f = fs.open(name)
+    total = 0
+    while True:
+        s = f.read(chunk)
+        if not s:
+            break
+        total += len(s)
+    f.close()
+    fs.close()
+    Volume.vclose(part)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mib", type=int, default=16, help="file size in MiB")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(
+            make_disk_image(
+                os.path.join(tmp, "bench.img"),
+                fstype="FAT32",
+                boot_size=(args.mib + 40) << 20,
+            )
+        )
+        part = Volume.vopen(path, "r+b", "partition0")
+        fs = Volume.openvolume(part)
+        f = fs.create("payload.bin")
+        f.write(os.urandom(args.mib << 20))
+        f.close()
+        fs.close()
+        Volume.vclose(part)
+
+        print(f"{'case':<28}{'disk (s)':>12}{'mmap (s)':>12}{'speedup':>10}")
+        for chunk in (4096, 64 << 10, 1 << 20):
+            times = {}
+            for mapped in (False, True):
+                start = time.perf_counter()
+                for _ in range(args.rounds):
+                    size = open_and_read(path, "payload.bin", mapped, chunk)
+                times[mapped] = (time.perf_counter() - start) / args.rounds
+                assert size == args.mib << 20
+            name = f"open + read, {chunk >> 10} KiB reads"
+            print(
+                f"{name:<28}{times[False]:>12.3f}{times[True]:>12.3f}"
+                f"{times[False] / times[True]:>9.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Benchmark reads from virtual disk images.
+
+Writes the same random data to a raw file, to a dynamic VHD and, as sparse
+sector writes, to a differencing VHD over it, then times reading the whole
+disk in 1 MiB chunks: from the raw file, with the per-sector loop that
+`vhdutils.Image.read1` used before on the differencing image, and with
+`Image.readinto` on each VHD.
+
+Usage: uv run python benchmarks/bench_vdisk_read.py [--mib N]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from chi_edge.vendor.FATtools import vhdutils
+
+CHUNK = 1 << 20
+
+
+def legacy_read1(image, size):
+    """The previous differencing VHD read: one 512 bytes sector at a time."""
+    buf = bytearray()
+    bmp = None
+    while size:
+        batind = image._pos // image.block
+        sector = (image._pos - batind * image.block) // 512
+        offset = image._pos % 512
+        got = min(size, 512 - offset)
+        size -= got
+        block = image.bat[batind]
+        image._pos += got
+        if not bmp or bmp.i != block:
+            if block != 0xFFFFFFFF:
+                image.stream.seek(block * 512)
+                bmp = vhdutils.BlockBitmap(image.stream.read(image.bitmap_size), block)
+        if block == 0xFFFFFFFF or not bmp.isset(sector):
+            image.Parent.seek(image._pos - got)
+            buf += image.Parent.read(got)
+        else:
+            image.stream.seek(block * 512 + image.bitmap_size + sector * 512 + offset)
+            buf += image.stream.read(got)
+    return buf
+
+
+def timed(read, size):
+    """Seconds taken by reading `size` bytes in chunks with `read(buf)`."""
+    buf = bytearray(CHUNK)
+    start = time.perf_counter()
+    for _ in range(size // CHUNK):
+        read(buf)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mib", type=int, default=64, help="disk size in MiB")
+    args = parser.parse_args()
+    size = args.mib << 20
+    rng = random.Random(42)
+    tmp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    data = rng.randbytes(size)
+    with open("disk.img", "wb") as f:
+        f.write(data)
+    vhdutils.mk_dynamic("base.vhd", size)
+    image = vhdutils.Image("base.vhd", "r+b")
+    image.write(data)
+    image.close()
+    vhdutils.mk_diff("child.vhd", os.path.abspath("base.vhd"))
+    image = vhdutils.Image("child.vhd", "r+b")
+    for _ in range(size >> 16):  # one sector in 128 is rewritten
+        image.seek(rng.randrange(size // 512) * 512)
+        image.write(rng.randbytes(512))
+    image.close()
+
+    print(f"{'reader':<28}{'MiB/s':>10}")
+    with open("disk.img", "rb") as f:
+        print(f"{'raw file':<28}{args.mib / timed(f.readinto, size):>10.1f}")
+    for name, label, read in (
+        ("child.vhd", "differencing, per sector", None),
+        ("base.vhd", "dynamic, readinto", "readinto"),
+        ("child.vhd", "differencing, readinto", "readinto"),
+    ):
+        image = vhdutils.Image(name, "rb")
+        if read:
+            elapsed = timed(image.readinto, size)
+        else:
+            elapsed = timed(lambda buf: legacy_read1(image, len(buf)), size)
+        print(f"{label:<28}{args.mib / elapsed:>10.1f}")
+        image.close()
+    os.chdir(cwd)
+    shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
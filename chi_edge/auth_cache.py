@@ -0,0 +1,62 @@
+"""Keystone tokens cached across CLI invocations.
+
+The authentication state of a keystoneauth plugin, the scoped token with its
+service catalog, is saved in the user cache directory, readable by the user
+only. A later invocation for the same cloud and credentials installs it in
+its plugin, so that the inventory endpoint is found in the cached catalog
+and the first Doni request is the only HTTP round trip. Entries are dropped
+when their token expires; a token revoked earlier is answered with a 401,
+on which keystoneauth authenticates again.
+"""
+
+import time
+from datetime import timezone
+
+from chi_edge.utils import load_json_cache, save_json_cache
+
+AUTH_CACHE_FILE = "auth.json"
+# Tokens expiring sooner are not reused, as in keystoneauth
+MIN_TOKEN_LIFE = 120
+
+
+def _key(cloud, auth):
+    # The cache id hashes the plugin's auth options, credentials included
+    cache_id = auth.get_cache_id()
+    return f"{cloud or ''}/{cache_id}" if cache_id else None
+
+
+def _live_entries():
+    now = time.time()
+    return {
+        key: entry
+        for key, entry in load_json_cache(AUTH_CACHE_FILE).items()
+        if isinstance(entry, dict) and entry.get("expires_at", 0) > now + MIN_TOKEN_LIFE
+    }
+
+
+def load_auth_state(cloud: "str", auth) -> bool:
+    """Install the token cached for `cloud` in the keystoneauth plugin `auth`.
+    Returns whether there was one."""
+    key = _key(cloud, auth)
+    entry = _live_entries().get(key) if key else None
+    if not entry:
+        return False
+    auth.set_auth_state(entry["state"])
+    return True
+
+
+def save_auth_state(cloud: "str", auth):
+    """Cache the token of the keystoneauth plugin `auth`, if it has one."""
+    key = _key(cloud, auth)
+    state = auth.get_auth_state() if key else None
+    if not state:
+        return
+    expires = auth.auth_ref.expires
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=timezone.utc)
+    cache = _live_entries()
+    if cache.get(key, {}).get("state") == state:
+        return
+    cache[key] = {"state": state, "expires_at": expires.timestamp()}
+    # save_json_cache writes through mkstemp, so the file is mode 0600
+    save_json_cache(AUTH_CACHE_FILE, cache)
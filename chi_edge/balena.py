@@ -0,0 +1,94 @@
+"""balenaOS `config.json` of the devices enrolled in Doni."""
+
+import os
+
+from chi_edge import compressed
+from chi_edge.image import BootPartition, clone_image, find_boot_partition
+from chi_edge.utils import parse_date
+
+
+def balena_credentials(hardware) -> "tuple[str, str] | None":
+    """The (device API key, fleet ID) of a device, or None until the Balena
+    worker has finished its enrollment."""
+    for worker in hardware["workers"]:
+        if worker["worker_type"] == "balena":
+            details = worker["state_details"]
+            if details.get("device_api_key") and details.get("fleet_id"):
+                return details["device_api_key"], details["fleet_id"]
+            return None
+    return None
+
+
+def patch_config(
+    config, hardware, boot_target_device: "str" = None, boot_migrate_force=False
+):
+    """Set the keys of `config.json` that make the device join its fleet."""
+    device_api_key, fleet_id = balena_credentials(hardware)
+    # Copy over needed keys to config
+    config["uuid"] = hardware["uuid"].replace("-", "").lower()
+    config["hostname"] = hardware["name"]
+    config["applicationId"] = fleet_id
+    config["userId"] = None
+    config["deviceApiKey"] = device_api_key
+    config["deviceApiKeys"] = {"api.balena-cloud.com": device_api_key}
+    config["registered_at"] = config["registeredAt"] = str(
+        # Store in microseconds
+        int(parse_date(hardware["created_at"]).timestamp() * 1000)
+    )
+    # Sometimes the pre-baked config.json image has this set in its file
+    if "apiKey" in config:
+        del config["apiKey"]
+
+    if boot_target_device or boot_migrate_force:
+        installer = config.get("installer", {})
+        if boot_target_device:
+            installer["boot_target_devices"] = boot_target_device
+        if boot_migrate_force:
+            installer.setdefault("migrate", {})["force"] = True
+        config["installer"] = installer
+
+    config["appUpdatePollInterval"] = "60000"
+    # This is the default Balena supervisor listen port
+    config["listenPort"] = "48484"
+    config["vpnPort"] = "443"
+    config["apiEndpoint"] = "https://api.balena-cloud.com"
+    config["vpnEndpoint"] = "vpn.balena-cloud.com"
+    config["registryEndpoint"] = "registry2.balena-cloud.com"
+    config["deltaEndpoint"] = "https://delta.balena-cloud.com"
+    return config
+
+
+def bake_device_image(
+    image: "str",
+    output: "str",
+    hardware,
+    boot_target_device: "str" = None,
+    boot_migrate_force=False,
+) -> str:
+    """Write `output`, a copy of `image` configured for the device.
+
+    Compressed images are streamed (see `compressed.bake_stream`), raw ones
+    cloned (see `clone_image`). This is a job of the enrollment process pool:
+    it only takes and returns picklable values.
+    """
+
+    def configure(boot):
+        try:
+            config = boot.read_json("config.json")
+        except Exception:
+            config = {}
+        patch_config(config, hardware, boot_target_device, boot_migrate_force)
+        boot.write_json("config.json", config)
+
+    if compressed.is_compressed(image) or compressed.is_compressed(output):
+        compressed.bake_stream(image, output, configure)
+        return output
+    part = find_boot_partition(image)
+    clone_image(image, output)
+    try:
+        with BootPartition(output, part) as boot:
+            configure(boot)
+    except BaseException:
+        os.unlink(output)
+        raise
+    return output
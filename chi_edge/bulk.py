@@ -0,0 +1,39 @@
+"""Running one call per item on a bounded thread pool, at a bounded rate."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateLimiter:
+    """Spaces the returns from `wait`, across threads, 1/rate seconds apart."""
+
+    def __init__(self, rate: "float" = None):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next, now)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def run_concurrently(fn, items, workers: "int" = 8, rate: "float" = None):
+    """Call `fn(item)` for every item, on at most `workers` threads and starting
+    at most `rate` calls per second. Returns the (result, exception) pairs in
+    the order of `items`: exceptions are collected, not raised."""
+    limiter = RateLimiter(rate)
+
+    def call(item):
+        limiter.wait()
+        try:
+            return fn(item), None
+        except Exception as ex:
+            return None, ex
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(call, items))
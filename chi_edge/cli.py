@@ -12,28 +12,51 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import contextlib
+import importlib
 import json
 import logging
-from datetime import datetime
 from pathlib import Path
 from uuid import UUID
 from typing import Any
 
 import click
-import openstack
-import yaml
-from keystoneauth1 import adapter
-from keystoneauth1 import exceptions as ksa_exc
-from rich import box
-from rich.console import Console
-from rich.panel import Panel
-from rich.table import Table
-from rich.text import Text
 
 from chi_edge import LOCAL_EGRESS, SUPPORTED_MACHINE_NAMES, utils
-from chi_edge.image import find_boot_partition_id, read_config_json, write_config_json
 
-console = Console()
+
+class _Lazy:
+    """Stands for the object made by `factory`, made on first attribute access.
+
+    The OpenStack SDK, keystoneauth, rich and the image modules take most of
+    the CLI start time; they are only loaded by the commands using them.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._obj = None
+
+    def __getattr__(self, name):
+        if self._obj is None:
+            self._obj = self._factory()
+        return getattr(self._obj, name)
+
+
+def _lazy_import(name):
+    return _Lazy(lambda: importlib.import_module(name))
+
+
+openstack = _lazy_import("openstack")
+adapter = _lazy_import("keystoneauth1.adapter")
+auth_cache = _lazy_import("chi_edge.auth_cache")
+device_index = _lazy_import("chi_edge.device_index")
+bulk_utils = _lazy_import("chi_edge.bulk")
+balena = _lazy_import("chi_edge.balena")
+enroll_utils = _lazy_import("chi_edge.enroll")
+ksa_exc = _lazy_import("keystoneauth1.exceptions")
+image_utils = _lazy_import("chi_edge.image")
+overlay_utils = _lazy_import("chi_edge.overlay")
+compressed = _lazy_import("chi_edge.compressed")
+console = _Lazy(lambda: importlib.import_module("rich.console").Console())
 
 
 class BaseCommand(click.Command):
@@ -53,12 +76,83 @@ class BaseCommand(click.Command):
         return super().invoke(ctx)
 
 
+def parse_selectors(ctx, param, values):
+    selectors = []
+    for value in values:
+        key, sep, expected = value.partition("=")
+        if not sep:
+            raise click.BadParameter(f"'{value}' is not KEY=VALUE")
+        selectors.append((key, expected))
+    return selectors
+
+
+def bulk_options(command):
+    """Options of the commands acting on several devices at once."""
+    options = [
+        click.option(
+            "--all",
+            "all_",
+            is_flag=True,
+            default=False,
+            help="Act on every device in the inventory.",
+        ),
+        click.option(
+            "--selector",
+            "selectors",
+            metavar="KEY=VALUE",
+            multiple=True,
+            callback=parse_selectors,
+            help=(
+                "Act on the devices whose field or property KEY is VALUE (or, for "
+                "a list, contains it), e.g. machine_name=raspberrypi5. Repeat to "
+                "require several."
+            ),
+        ),
+        click.option(
+            "--from-file",
+            type=click.File("r"),
+            help=(
+                "Act on the devices listed in a file, one name or UUID per line "
+                "('-' for standard input)."
+            ),
+        ),
+        # Requests share one session, whose connection pools hold 10 connections
+        click.option(
+            "--concurrency",
+            type=click.IntRange(1, 10),
+            default=8,
+            show_default=True,
+            help="Requests in flight at once, when acting on several devices.",
+        ),
+        click.option(
+            "--rate",
+            type=click.FloatRange(0, min_open=True),
+            default=10,
+            show_default=True,
+            help="Requests started per second at most, when acting on several devices.",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
 @click.group()
 @click.option(
     "--os-cloud", envvar="OS_CLOUD", default=None, help="clouds.yaml cloud name"
 )
+@click.option(
+    "--auth-cache/--no-auth-cache",
+    "use_auth_cache",
+    envvar="CHI_EDGE_AUTH_CACHE",
+    default=False,
+    help=(
+        "Reuse the Keystone token of an earlier invocation for the same cloud "
+        "until it expires, saved in the user cache directory (mode 0600)."
+    ),
+)
 @click.pass_context
-def cli(ctx, os_cloud):
+def cli(ctx, os_cloud, use_auth_cache):
     """Tools for interacting with the CHI@Edge testbed.
 
     See the list of subcommands for futher details about device enrollment or other
@@ -66,6 +160,7 @@ def cli(ctx, os_cloud):
     """
     ctx.ensure_object(dict)
     ctx.obj["os_cloud"] = os_cloud
+    ctx.obj["auth_cache"] = use_auth_cache
 
 
 @cli.group("device", short_help="manage or register devices")
@@ -154,8 +249,7 @@ def register(
         if not utils.validate_rfc1123_name(device_name):
             raise click.ClickException("device name must match RFC1123 DNS")
 
-        ctx = click.get_current_context()
-        conn = openstack.connect(cloud=ctx.obj.get("os_cloud"))
+        conn = connect()
 
         if bool(application_credential_id) != bool(application_credential_secret):
             raise click.ClickException(
@@ -182,26 +276,126 @@ def register(
             application_credential_secret = app_cred.secret
             console.print(f"Created application credential [bold]{app_cred.id}[/bold]")
 
-        device = (
-            doni_client(conn)
-            .post(
-                "/v1/hardware/",
-                json={
-                    "name": device_name,
-                    "hardware_type": "device.balena",
-                    "properties": {
-                        "application_credential_id": application_credential_id,
-                        "application_credential_secret": application_credential_secret,
-                        "contact_email": contact_email,
-                        "machine_name": machine_name,
-                    },
+        doni = doni_client(conn)
+        device = doni.post(
+            "/v1/hardware/",
+            json={
+                "name": device_name,
+                "hardware_type": "device.balena",
+                "properties": {
+                    "application_credential_id": application_credential_id,
+                    "application_credential_secret": application_credential_secret,
+                    "contact_email": contact_email,
+                    "machine_name": machine_name,
                 },
-            )
-            .json()
-        )
+            },
+        ).json()
+        device_index.remember(index_scope(doni), device["name"], device["uuid"])
         print_device(device)
 
 
+@device.command(cls=BaseCommand, short_help="register and bake devices in bulk")
+@click.option(
+    "--manifest",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="YAML file listing the devices, their machine names and images.",
+)
+@click.option(
+    "--state",
+    metavar="PATH",
+    help=(
+        "File recording the progress, to resume an interrupted enrollment "
+        "(default: the manifest path with a .state.json suffix)."
+    ),
+)
+@click.option(
+    "--replace-credentials",
+    is_flag=True,
+    default=False,
+    help="Recreate the application credentials that already exist for a device.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(1, 10),
+    default=8,
+    show_default=True,
+    help="Registrations in flight at once.",
+)
+@click.option(
+    "--rate",
+    type=click.FloatRange(0, min_open=True),
+    default=10,
+    show_default=True,
+    help="Registrations started per second at most.",
+)
+@click.option(
+    "--bake-processes",
+    type=click.IntRange(1),
+    help="Images baked at once (default: the number of CPUs).",
+)
+@click.option(
+    "--timeout",
+    type=click.IntRange(0),
+    default=1800,
+    show_default=True,
+    help="Seconds to wait for the registered devices to be ready.",
+)
+def enroll(
+    manifest: "str",
+    state: "str" = None,
+    replace_credentials: bool = False,
+    concurrency: int = 8,
+    rate: float = 10,
+    bake_processes: int = None,
+    timeout: int = 1800,
+):
+    """Register the devices of a MANIFEST, wait until they are ready and bake
+    an image for each, as `register` and `bake` would do one at a time.
+
+    \b
+    An example manifest:
+        defaults:
+          machine_name: raspberrypi4-64
+          contact_email: me@example.org
+          image: balena.img.gz
+          output: "{name}.img.gz"
+        devices:
+          - rack1-pi01
+          - name: rack1-pi02
+            machine_name: raspberrypi5
+
+    Running the same command again after an interruption or a failure resumes
+    the enrollment from its state file.
+    """
+    state = state or str(Path(manifest).with_suffix(".state.json"))
+    try:
+        devices = enroll_utils.load_manifest(manifest)
+    except enroll_utils.ManifestError as ex:
+        raise click.ClickException(str(ex))
+
+    with doni_error_handler("failed to enroll devices"):
+        conn = connect()
+        enrollment = enroll_utils.Enrollment(conn, doni_client(conn), devices, state)
+        enrollment.register(concurrency, rate, replace_credentials)
+        enrollment.wait_and_bake(bake_processes, timeout)
+
+    from rich.text import Text
+
+    table = make_table("Device", "UUID", "Stage", "Result")
+    failed = 0
+    for name, uuid, stage, error in enrollment.results():
+        failed += bool(error)
+        result = Text(error, style="red") if error else Text("ok", style="green")
+        table.add_row(name, uuid or "--", stage or "--", result)
+    console.print(table)
+    if failed:
+        raise click.ClickException(
+            f"{failed} of {len(devices)} device(s) failed; run the command again "
+            "to resume"
+        )
+
+
 @device.command("list", cls=BaseCommand, short_help="list registered devices")
 @click.option(
     "--long",
@@ -212,7 +406,9 @@ def register(
 )
 def list_all(long_: "bool" = False):
     with doni_error_handler("failed to list devices"):
-        devices = doni_client().get("/v1/hardware/").json()["hardware"]
+        doni = doni_client()
+        devices = doni.get("/v1/hardware/").json()["hardware"]
+        device_index.update(index_scope(doni), devices)
         table = make_table()
         table.add_column("Name")
         table.add_column("UUID")
@@ -257,13 +453,12 @@ def list_all(long_: "bool" = False):
 @click.argument("device")
 def show(device: "str"):
     with doni_error_handler("failed to fetch device"):
-        doni = doni_client()
-        uuid = resolve_device(doni, device)
-        print_device(doni.get(f"/v1/hardware/{uuid}/").json())
+        hardware, _ = device_request(doni_client(), device, "get")
+        print_device(hardware.json())
 
 
 @device.command(cls=BaseCommand, short_help="update registered device details")
-@click.argument("device")
+@click.argument("devices", nargs=-1)
 @click.option("--contact-email")
 @click.option("--application-credential-id")
 @click.option("--application-credential-secret")
@@ -290,8 +485,9 @@ def show(device: "str"):
     multiple=True,
     help="Property to clear. Repeat for multiple.",
 )
+@bulk_options
 def set(
-    device: "str",
+    devices: "tuple[str, ...]",
     contact_email: "str" = None,
     application_credential_id: "str" = None,
     application_credential_secret: "str" = None,
@@ -299,7 +495,11 @@ def set(
     authorized_projects_reason: "str" = None,
     local_egress: "str" = None,
     unset: "tuple[str, ...]" = (),
+    **bulk_args,
 ):
+    """Update the details of DEVICES, given by name or UUID, or of the devices
+    chosen with --all, --selector or --from-file."""
+
     def patch_to(prop, value):
         return {"op": "add", "path": f"/properties/{prop}", "value": value}
 
@@ -310,8 +510,6 @@ def set(
             )
 
     with doni_error_handler("failed to fetch device"):
-        doni = doni_client()
-        uuid = resolve_device(doni, device)
         patch = []
         if contact_email:
             patch.append(patch_to("contact_email", contact_email))
@@ -335,13 +533,25 @@ def set(
             patch.append(patch_to("local_egress", local_egress))
         for prop in unset:
             patch.append({"op": "remove", "path": f"/properties/{prop}"})
-        print_device(doni.patch(f"/v1/hardware/{uuid}/", json=patch).json())
+        device = single_device(devices, bulk_args)
+        doni = doni_client()
+        if device:
+            hardware, _ = device_request(doni, device, "patch", json=patch)
+            print_device(hardware.json())
+            return
+        targets = select_devices(doni, devices, bulk_args)
+        bulk_device_request(doni, targets, "patch", "", bulk_args, json=patch)
 
 
 @device.command(cls=BaseCommand, short_help="delete registered device")
-@click.argument("device")
+@click.argument("devices", nargs=-1)
 @click.option("--yes-i-really-really-mean-it", is_flag=True)
-def delete(device: "str", yes_i_really_really_mean_it: "bool" = False):
+@bulk_options
+def delete(
+    devices: "tuple[str, ...]", yes_i_really_really_mean_it: "bool" = False, **bulk_args
+):
+    """Delete DEVICES, given by name or UUID, or the devices chosen with --all,
+    --selector or --from-file."""
     if not yes_i_really_really_mean_it:
         raise click.ClickException(
             "Are you sure? Specify --yes-i-really-really-mean-it if so. Deleting the "
@@ -349,20 +559,40 @@ def delete(device: "str", yes_i_really_really_mean_it: "bool" = False):
             "current users of the device on the testbed."
         )
     with doni_error_handler("failed to delete device"):
+        device = single_device(devices, bulk_args)
         doni = doni_client()
-        uuid = resolve_device(doni, device)
-        doni.delete(f"/v1/hardware/{uuid}/")
-        print("Successfully deleted device")
+        if device:
+            _, uuid = device_request(doni, device, "delete")
+            device_index.forget(index_scope(doni), [uuid])
+            print("Successfully deleted device")
+            return
+        targets = select_devices(doni, devices, bulk_args)
+        scope = index_scope(doni)
+        bulk_device_request(
+            doni,
+            targets,
+            "delete",
+            "",
+            bulk_args,
+            succeeded=lambda uuids: device_index.forget(scope, uuids),
+        )
 
 
 @device.command(cls=BaseCommand, short_help="force device re-sync")
-@click.argument("device")
-def sync(device: "str"):
+@click.argument("devices", nargs=-1)
+@bulk_options
+def sync(devices: "tuple[str, ...]", **bulk_args):
+    """Force the re-sync of DEVICES, given by name or UUID, or of the devices
+    chosen with --all, --selector or --from-file."""
     with doni_error_handler("failed to sync device"):
+        device = single_device(devices, bulk_args)
         doni = doni_client()
-        uuid = resolve_device(doni, device)
-        doni.post(f"/v1/hardware/{uuid}/sync/")
-        print("Successfully started device re-sync")
+        if device:
+            device_request(doni, device, "post", "sync/")
+            print("Successfully started device re-sync")
+            return
+        targets = select_devices(doni, devices, bulk_args)
+        bulk_device_request(doni, targets, "post", "sync/", bulk_args)
 
 
 @device.command(
@@ -396,24 +626,75 @@ def sync(device: "str"):
         "shutting down. Sets installer.migrate.force in config.json."
     ),
 )
+@click.option(
+    "--output",
+    metavar="PATH",
+    help=(
+        "Configure a copy of the image at PATH instead of the image itself. "
+        "The copy is a reflink where the file system supports it, otherwise "
+        "a sparse copy. A PATH ending in .gz, .xz or .zip is compressed, "
+        "in one pass over the image."
+    ),
+)
+@click.option(
+    "--overlay",
+    metavar="PATH",
+    help=(
+        "Save the changes to the image in an overlay file at PATH instead of "
+        "writing them to the image. See `chi-edge image apply`."
+    ),
+)
+@click.option(
+    "--partition-cache/--no-partition-cache",
+    default=True,
+    help=(
+        "Reuse the boot partition location found earlier for the same image "
+        "instead of scanning its partition table."
+    ),
+)
+@click.option(
+    "--clear-partition-cache",
+    is_flag=True,
+    default=False,
+    help="Forget all cached boot partition locations before baking.",
+)
 def bake(
     device: "str",
     image: "str" = None,
     boot_target_device: "str" = None,
     boot_migrate_force: bool = False,
+    output: "str" = None,
+    overlay: "str" = None,
+    partition_cache: bool = True,
+    clear_partition_cache: bool = False,
 ):
 
     config_file = Path("config.json")
     # Ensure we do not overwrite a `config.json` file on the user's system
-    if config_file.exists():
+    if not image and config_file.exists():
         raise click.ClickException("'config.json' already exists!")
 
+    if output and overlay:
+        raise click.ClickException("--output and --overlay are mutually exclusive")
+    streamed = bool(image and output) and (
+        compressed.is_compressed(image) or compressed.is_compressed(output)
+    )
+    if image and compressed.is_compressed(image) and not output:
+        raise click.ClickException("A compressed --image requires --output")
+    for target in (output, overlay):
+        if target and not image:
+            raise click.ClickException("--output and --overlay require --image")
+        if target and Path(target).exists():
+            raise click.ClickException(f"'{target}' already exists!")
+
+    if clear_partition_cache:
+        image_utils.clear_partition_cache()
+
     device_hw = None
     with doni_error_handler("failed to bake device"):
         # Check for device in doni
-        doni = doni_client()
-        device_uuid = resolve_device(doni, device)
-        device_hw = doni.get(f"/v1/hardware/{device_uuid}/").json()
+        hardware, _ = device_request(doni_client(), device, "get")
+        device_hw = hardware.json()
         balena_workers = [
             worker
             for worker in device_hw["workers"]
@@ -426,98 +707,138 @@ def bake(
             "registration again"
         )
 
-    balena_worker = balena_workers[0]["state_details"]
-    balena_device_api_key = balena_worker.get("device_api_key")
-    balena_fleet_id = balena_worker.get("fleet_id")
-
-    if not (balena_device_api_key and balena_fleet_id):
+    if not balena.balena_credentials(device_hw):
         raise click.ClickException(
             "Device has not finished enrollment in Balena yet. Please wait a minute "
             "and try again, or check the state of the registration to see if it is in "
             "error."
         )
 
-    boot_part_id = 0
-    # If image is present, find the boot partition
-    if image:
-        boot_part_id = find_boot_partition_id(image)
+    def patch_config(config):
+        return balena.patch_config(
+            config, device_hw, boot_target_device, boot_migrate_force
+        )
+
+    if not image:
+        config = patch_config({})
+        with config_file.open("w") as f:
+            json.dump(config, f, indent=2)
+        print("Created 'config.json'")
+        return
 
-    # Copy existing config file. For an unconfigured OS, it seems this
-    # just contains `deviceType`
-    if image:
+    def configure(boot):
+        # Copy existing config file. For an unconfigured OS, it seems this
+        # just contains `deviceType`
         try:
-            config = read_config_json(image, boot_part_id, "config.json")
+            config = boot.read_json("config.json")
         except Exception:
             # This can fail for a number of reasons, mainly if the file for w/e reason
             # is not inside the image (or if that fils is malformed JSON?)
             console.print_exception()
             config = {}
-    else:
-        config = {}
-
-    # Copy over needed keys to config
-    config["uuid"] = device_uuid.replace("-", "").lower()
-    config["hostname"] = device_hw["name"]
-    config["applicationId"] = balena_fleet_id
-    config["userId"] = None
-    config["deviceApiKey"] = balena_device_api_key
-    config["deviceApiKeys"] = {"api.balena-cloud.com": balena_device_api_key}
-    config["registered_at"] = config["registeredAt"] = str(
-        # Store in microseconds
-        int(parse_date(device_hw["created_at"]).timestamp() * 1000)
-    )
-    # Sometimes the pre-baked config.json image has this set in its file
-    if "apiKey" in config:
-        del config["apiKey"]
-
-    if boot_target_device or boot_migrate_force:
-        installer = config.get("installer", {})
-        if boot_target_device:
-            installer["boot_target_devices"] = boot_target_device
-        if boot_migrate_force:
-            installer.setdefault("migrate", {})["force"] = True
-        config["installer"] = installer
-
-    config["appUpdatePollInterval"] = "60000"
-    # This is the default Balena supervisor listen port
-    config["listenPort"] = "48484"
-    config["vpnPort"] = "443"
-    config["apiEndpoint"] = "https://api.balena-cloud.com"
-    config["vpnEndpoint"] = "vpn.balena-cloud.com"
-    config["registryEndpoint"] = "registry2.balena-cloud.com"
-    config["deltaEndpoint"] = "https://delta.balena-cloud.com"
-
-    # Put config data back into image
-    with config_file.open("w") as f:
-        json.dump(config, f, indent=2)
-
-    if image:
-        write_config_json(image, boot_part_id, "config.json", config)
+        patch_config(config)
 
+        # Put config data back into image
         try:
-            written_config = read_config_json(image, boot_part_id, "config.json")
-        except Exception as ex:
+            boot.write_json("config.json", config)
+        except image_utils.ImageError as ex:
             print(ex)
-            raise (ex)
+            exit(1)
+
+    if streamed:
+        # Only the head of the image, up to the end of the boot partition, is
+        # held in memory; the rest is copied as it is decompressed
+        print(
+            f"Streaming '{image}' to '{output}', buffering at most "
+            f"{compressed.STREAM_BUFFER_LIMIT >> 20} MiB of it in memory"
+        )
+        try:
+            compressed.bake_stream(image, output, configure)
+        except image_utils.ImageError as ex:
+            raise click.ClickException(str(ex))
+        print("Successfully patched image, verified config file")
+        return
+
+    base = image
+    boot_part = None
+    if output or overlay:
+        # The base image is left untouched: its layout is also the copy's
+        boot_part = image_utils.find_boot_partition(image, partition_cache)
+    if output:
+        method = image_utils.clone_image(image, output)
+        print(f"Copied '{image}' to '{output}' ({method})")
+        image = output
+    elif overlay:
+        image = overlay_utils.open_overlay_disk(base)
+
+    # The boot partition is mounted once to read, patch and verify the config
+    with image_utils.BootPartition(image, boot_part, cache=partition_cache) as boot:
+        configure(boot)
+    if overlay:
+        extents = image.extents()
+        overlay_utils.write_overlay(overlay, base, extents)
+        print(
+            f"Saved {len(extents)} changed extent(s), "
+            f"{sum(len(data) for _, data in extents)} bytes, to '{overlay}'"
+        )
+    print("Successfully patched image, verified config file")
+
+
+@cli.group("image", short_help="work with baked OS images")
+def image_group():
+    pass
+
+
+@image_group.command("apply", cls=BaseCommand, short_help="apply a bake overlay")
+@click.argument("base", type=click.Path(exists=True, dir_okay=False))
+@click.argument("overlay", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--output",
+    metavar="PATH",
+    help="Write the image to PATH (a reflink or sparse copy where possible).",
+)
+def apply(base: "str", overlay: "str", output: "str" = None):
+    """Merge the raw image BASE with an OVERLAY saved by `bake --overlay`.
+
+    The baked image is written to standard output, e.g. to pipe it to `dd`,
+    unless --output is given.
+    """
+    try:
+        patch = overlay_utils.read_overlay(overlay)
+        if output:
+            if Path(output).exists():
+                raise click.ClickException(f"'{output}' already exists!")
+            overlay_utils.apply_overlay(base, patch, output)
         else:
-            if config == written_config:
-                print("Successfully patched image, verified config file")
-            else:
-                print("Written config does not match")
-                exit(1)
-        config_file.unlink()
-    else:
-        print("Created 'config.json'")
+            overlay_utils.stream_overlay(base, patch, click.get_binary_stream("stdout"))
+    except image_utils.ImageError as ex:
+        raise click.ClickException(str(ex))
+
+
+def connect():
+    """Connect to the cloud selected by --os-cloud, reusing the cached token
+    with --auth-cache (and caching the token in use once the command ends)."""
+    ctx = click.get_current_context()
+    cloud = ctx.obj.get("os_cloud")
+    conn = openstack.connect(cloud=cloud)
+    if ctx.obj.get("auth_cache"):
+        auth = conn.session.auth
+        auth_cache.load_auth_state(cloud, auth)
+        ctx.call_on_close(lambda: auth_cache.save_auth_state(cloud, auth))
+    return conn
 
 
 def doni_client(conn=None):
     if not conn:
-        ctx = click.get_current_context()
-        conn = openstack.connect(cloud=ctx.obj.get("os_cloud"))
+        conn = connect()
     return adapter.Adapter(conn.session, interface="public", service_type="inventory")
 
 
 def print_device(hardware):
+    from rich.panel import Panel
+    from rich.table import Table
+    from rich.text import Text
+
     outer = Table(show_header=False, padding=(0, 0), pad_edge=False, show_edge=False)
     table = make_table()
     table.add_column("Property")
@@ -545,19 +866,36 @@ def doni_error_handler(default_message):
     except ksa_exc.AuthPluginException as auth_err:
         raise click.ClickException(f"{default_message}: {auth_err}")
     except ksa_exc.HttpError as http_err:
-        try:
-            message = http_err.response.json()["error"]
-        except Exception:
-            message = http_err.message
-        raise click.ClickException(message)
+        raise click.ClickException(http_error_message(http_err))
+
+
+def http_error_message(http_err):
+    try:
+        return http_err.response.json()["error"]
+    except Exception:
+        return http_err.message
+
+
+def index_scope(doni_client) -> "str":
+    """Scope of the device index: the cloud and the credentials in use."""
+    cloud = click.get_current_context().obj.get("os_cloud")
+    return f"{cloud or ''}/{doni_client.session.auth.get_cache_id() or ''}"
 
 
-def resolve_device(doni_client, device_ref: "str"):
+def resolve_device(doni_client, device_ref: "str", use_index=True):
     try:
-        uuid = str(UUID(device_ref))
+        return str(UUID(device_ref))
     except ValueError:
-        uuid = None
-        for d in doni_client.get("/v1/hardware/").json()["hardware"]:
+        pass
+
+    # Names are looked up in the local index first, and only then in the
+    # full inventory listing, which refreshes the index
+    scope = index_scope(doni_client)
+    uuid = device_index.lookup(scope, device_ref) if use_index else None
+    if not uuid:
+        devices = doni_client.get("/v1/hardware/").json()["hardware"]
+        device_index.update(scope, devices)
+        for d in devices:
             if d["name"] == device_ref:
                 uuid = d["uuid"]
                 break
@@ -568,27 +906,161 @@ def resolve_device(doni_client, device_ref: "str"):
     return uuid
 
 
-def parse_date(utc_datestr):
-    parsed_date = datetime.strptime(utc_datestr, "%Y-%m-%dT%H:%M:%S+00:00")
-    return parsed_date
+def device_request(doni_client, device_ref: "str", method: "str", path="", **kwargs):
+    """Send a request for a device, given by name or UUID, to
+    `/v1/hardware/<uuid>/<path>`. Returns the response and the device UUID.
+
+    If the inventory does not know a UUID taken from the device index, the
+    name is looked up in the inventory and the request is sent once more.
+    """
+    uuid = resolve_device(doni_client, device_ref)
+    send = getattr(doni_client, method)
+    try:
+        return send(f"/v1/hardware/{uuid}/{path}", **kwargs), uuid
+    except ksa_exc.NotFound:
+        fresh = resolve_device(doni_client, device_ref, use_index=False)
+        if fresh == uuid:
+            raise
+    return send(f"/v1/hardware/{fresh}/{path}", **kwargs), fresh
+
+
+# Bulk requests are retried by keystoneauth, with an exponential backoff
+BULK_RETRIES = 3
+BULK_RETRIABLE_STATUS_CODES = [429, 502, 503, 504]
+
+
+def single_device(devices, bulk_args) -> "str | None":
+    """The device a command acts on, or None if it acts on several."""
+    if bulk_args["all_"] or bulk_args["selectors"] or bulk_args["from_file"]:
+        return None
+    if not devices:
+        raise click.UsageError("Missing DEVICES, or --all, --selector or --from-file")
+    return devices[0] if len(devices) == 1 else None
+
+
+def device_matches(device, selectors) -> bool:
+    for key, expected in selectors:
+        value = device[key] if key in device else device["properties"].get(key)
+        if isinstance(value, list) and expected in value:
+            continue
+        if value is None or str(value) != expected:
+            return False
+    return True
+
+
+def select_devices(doni_client, devices, bulk_args):
+    """The (name or UUID, UUID) of the devices a bulk command acts on: those
+    given by name or UUID or listed in --from-file, and those chosen with
+    --all or --selector. The UUID is None for unknown names.
+
+    Names are resolved against a single inventory listing, also used for
+    the selection, rather than the device index: no UUID is outdated.
+    """
+    refs = list(devices)
+    if bulk_args["from_file"]:
+        for line in bulk_args["from_file"]:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                refs.append(line)
+    uuids = {}
+    for ref in refs:
+        try:
+            uuids[ref] = str(UUID(ref))
+        except ValueError:
+            pass
+
+    selecting = bulk_args["all_"] or bulk_args["selectors"]
+    hardware = []
+    if selecting or len(uuids) < len(refs):
+        hardware = doni_client.get("/v1/hardware/").json()["hardware"]
+        device_index.update(index_scope(doni_client), hardware)
+    by_name = {d["name"]: d["uuid"] for d in hardware}
+    targets = [(ref, uuids.get(ref) or by_name.get(ref)) for ref in refs]
+    if selecting:
+        for d in hardware:
+            if device_matches(d, bulk_args["selectors"]):
+                targets.append((d["name"], d["uuid"]))
+
+    # Drop duplicates, keeping the first mention of each device
+    selected = {}
+    for ref, uuid in targets:
+        selected.setdefault(uuid or ref, (ref, uuid))
+    if not selected:
+        raise click.ClickException("No device selected")
+    return list(selected.values())
+
+
+def bulk_device_request(
+    doni_client, targets, method, path, bulk_args, succeeded=None, **kwargs
+):
+    """Send a request to `/v1/hardware/<uuid>/<path>` for each (name, UUID)
+    target, concurrently, and print the outcomes in a table. `succeeded` is
+    called with the UUIDs whose request succeeded, even if others failed.
+    Raises ClickException if any request failed."""
+    from rich.text import Text
+
+    send = getattr(doni_client, method)
+
+    def request(uuid):
+        return send(
+            f"/v1/hardware/{uuid}/{path}",
+            connect_retries=BULK_RETRIES,
+            status_code_retries=BULK_RETRIES,
+            retriable_status_codes=BULK_RETRIABLE_STATUS_CODES,
+            **kwargs,
+        )
+
+    outcomes = iter(
+        bulk_utils.run_concurrently(
+            request,
+            [uuid for _, uuid in targets if uuid],
+            workers=bulk_args["concurrency"],
+            rate=bulk_args["rate"],
+        )
+    )
+    table = make_table("Device", "UUID", "Result")
+    failed, done = 0, []
+    for ref, uuid in targets:
+        error = "not found"
+        if uuid:
+            _, error = next(outcomes)
+        if isinstance(error, ksa_exc.HttpError):
+            error = http_error_message(error)
+        if error:
+            failed += 1
+            table.add_row(ref, uuid or "--", Text(str(error), style="red"))
+        else:
+            done.append(uuid)
+            table.add_row(ref, uuid, Text("ok", style="green"))
+    console.print(table)
+    if succeeded and done:
+        succeeded(done)
+    if failed:
+        raise click.ClickException(f"{failed} of {len(targets)} device(s) failed")
+    print(f"Successfully processed {len(targets)} device(s)")
 
 
 def localize(utc_datestr):
     if not utc_datestr:
         return utc_datestr
     try:
-        return parse_date(utc_datestr).astimezone().isoformat()
+        return utils.parse_date(utc_datestr).astimezone().isoformat()
     except ValueError:
         return utc_datestr
 
 
 def format_value(value):
     if isinstance(value, dict) or isinstance(value, list):
+        import yaml
+
         return yaml.dump(value).strip()
     return value
 
 
 def make_table(*headers, **kwargs):
+    from rich import box
+    from rich.table import Table
+
     kwargs.setdefault("show_header", True)
     kwargs.setdefault("header_style", "bold green")
     kwargs.setdefault("box", box.MINIMAL_HEAVY_HEAD)
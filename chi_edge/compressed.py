@@ -0,0 +1,137 @@
+"""Baking compressed images (.img.gz, .img.xz, .zip) in a single pass.
+
+The image is decompressed as a stream. Only its head, up to the end of the
+boot partition and at most STREAM_BUFFER_LIMIT bytes, is held in memory,
+where `config.json` is patched through a ramdisk; every following byte is
+copied to the output, raw or compressed, unchanged.
+"""
+
+import contextlib
+import gzip
+import io
+import lzma
+import os
+import shutil
+import zipfile
+
+from chi_edge.image import BOOT_PARTITION_LABELS, BootPartition, ImageError
+from chi_edge.vendor.FATtools import Volume
+
+COMPRESSED_SUFFIXES = (".gz", ".xz", ".zip")
+# Bytes of decompressed image held in memory, at most
+STREAM_BUFFER_LIMIT = 512 << 20
+CHUNK = 1 << 20
+
+
+def is_compressed(path: "str") -> bool:
+    return path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def _zip_member(zf, path):
+    files = [info for info in zf.infolist() if not info.is_dir()]
+    images = [info for info in files if info.filename.lower().endswith(".img")]
+    if len(images) == 1:
+        return images[0]
+    if len(files) == 1:
+        return files[0]
+    raise ImageError(f"Cannot find a single .img file in '{path}'")
+
+
+@contextlib.contextmanager
+def open_image_stream(path: "str", mode="rb"):
+    """Open an image as a binary stream, decompressing (mode "rb") or
+    compressing (mode "xb", a new file) it as told by its suffix."""
+    lower = path.lower()
+    if lower.endswith(".gz"):
+        with gzip.open(path, mode, compresslevel=6) as f:
+            yield f
+    elif lower.endswith(".xz"):
+        with lzma.open(path, mode) as f:
+            yield f
+    elif lower.endswith(".zip") and mode == "rb":
+        with zipfile.ZipFile(path) as zf, zf.open(_zip_member(zf, path)) as f:
+            yield f
+    elif lower.endswith(".zip"):
+        name = os.path.basename(path)[:-4]
+        with zipfile.ZipFile(path, "x", zipfile.ZIP_DEFLATED) as zf:
+            with zf.open(name, "w", force_zip64=True) as f:
+                yield f
+    else:
+        with open(path, mode) as f:
+            yield f
+
+
+class _HeadBuffer:
+    """The head of a stream, read on demand into a BytesIO up to `limit`
+    bytes, with the seek/read interface the partition scanner needs."""
+
+    size = 0  # the image size is not known
+
+    def __init__(self, src, limit):
+        self.src = src
+        self.limit = limit
+        self.data = io.BytesIO()
+        self.pos = 0
+
+    def fill(self, end):
+        if end > self.limit:
+            raise ImageError(
+                f"The boot partition ends past the first {self.limit >> 20} MiB "
+                "of the image, which is all that is buffered"
+            )
+        have = self.data.seek(0, 2)
+        while have < end:
+            chunk = self.src.read(min(CHUNK, end - have))
+            if not chunk:
+                raise ImageError("Unexpected end of the image")
+            have += self.data.write(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:  # the size of the stream is not known
+            raise io.UnsupportedOperation("can't seek relative to the end")
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size):
+        self.fill(self.pos + size)
+        self.data.seek(self.pos)
+        self.pos += size
+        return bytearray(self.data.read(size))
+
+
+def bake_stream(src: "str", dst: "str", configure, limit=STREAM_BUFFER_LIMIT):
+    """Copy image `src` to the new file `dst`, calling `configure` with a
+    `BootPartition` session on the boot partition on the way.
+
+    Either image may be raw or compressed (see `open_image_stream`). Returns
+    the boot partition found.
+    """
+    with open_image_stream(src) as fsrc:
+        head = _HeadBuffer(fsrc, limit)
+        for part in Volume.iter_partitions(head):
+            if part.label in BOOT_PARTITION_LABELS:
+                break
+        else:
+            raise ImageError("Cannot find boot partition")
+        head.fill(part.offset + part.size)
+        with BootPartition(head.data, part) as boot:
+            configure(boot)
+
+        if os.path.exists(dst):
+            raise ImageError(f"'{dst}' already exists")
+        try:
+            with open_image_stream(dst, "xb") as fdst:
+                with head.data.getbuffer() as view:
+                    fdst.write(view)
+                shutil.copyfileobj(fsrc, fdst, CHUNK)
+        except BaseException:
+            if os.path.exists(dst):
+                os.unlink(dst)
+            raise
+    return part
@@ -0,0 +1,57 @@
+"""Device name to UUID index, kept in the user cache directory.
+
+Commands referring to a device by name look its UUID up here instead of
+listing the whole inventory. The index is per scope, the cloud and
+credentials in use; it is refreshed by every full listing and updated on
+registration and deletion. Entries are trusted for DEVICE_INDEX_TTL seconds.
+"""
+
+import time
+
+from chi_edge.utils import load_json_cache, save_json_cache
+
+DEVICE_INDEX_FILE = "device-index.json"
+DEVICE_INDEX_TTL = 600
+DEVICE_INDEX_SCOPES = 16
+
+
+def _update(scope, change):
+    cache = load_json_cache(DEVICE_INDEX_FILE)
+    names = cache.pop(scope, None)  # the most recent scope is last
+    names = change(names if isinstance(names, dict) else {})
+    cache[scope] = names
+    for old in list(cache)[:-DEVICE_INDEX_SCOPES]:
+        del cache[old]
+    save_json_cache(DEVICE_INDEX_FILE, cache)
+
+
+def lookup(scope: "str", name: "str") -> "str | None":
+    """UUID of device `name`, if indexed less than DEVICE_INDEX_TTL ago."""
+    names = load_json_cache(DEVICE_INDEX_FILE).get(scope)
+    entry = names.get(name) if isinstance(names, dict) else None
+    if not entry or entry[1] + DEVICE_INDEX_TTL < time.time():
+        return None
+    return entry[0]
+
+
+def update(scope: "str", devices):
+    """Replace the index with the devices of a full inventory listing."""
+    now = time.time()
+    _update(scope, lambda names: {d["name"]: [d["uuid"], now] for d in devices})
+
+
+def remember(scope: "str", name: "str", uuid: "str"):
+    def change(names):
+        names[name] = [uuid, time.time()]
+        return names
+
+    _update(scope, change)
+
+
+def forget(scope: "str", uuids):
+    """Drop the entries for the devices with these UUIDs from the index."""
+    uuids = frozenset(uuids)
+    _update(
+        scope,
+        lambda names: {k: entry for k, entry in names.items() if entry[0] not in uuids},
+    )
@@ -0,0 +1,297 @@
+"""Enrolling a fleet of devices listed in a manifest.
+
+The devices are registered concurrently, then the inventory is polled, for
+all of them at once and with a growing delay, until the Balena worker has
+enrolled each one; its image is baked in a process pool as soon as it has.
+Progress is saved in a state file after every step, so that an interrupted
+enrollment resumes where it stopped.
+
+A manifest is a YAML file such as:
+
+    defaults:
+      machine_name: raspberrypi4-64
+      contact_email: me@example.org
+      image: balena.img.gz
+      output: "{name}.img.gz"
+    devices:
+      - rack1-pi01
+      - name: rack1-pi02
+        machine_name: raspberrypi5
+
+A device is a name or a mapping of keys (see FIELDS), any of which can also
+be set in `defaults`. Devices without an `image` are only
+registered. `output` defaults to "{name}.img"; relative paths are relative
+to the manifest.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from chi_edge import SUPPORTED_MACHINE_NAMES
+from chi_edge.balena import bake_device_image, balena_credentials
+from chi_edge.bulk import run_concurrently
+from chi_edge.utils import validate_rfc1123_name, write_json_atomic
+
+FIELDS = {
+    "name",
+    "machine_name",
+    "contact_email",
+    "application_credential_id",
+    "application_credential_secret",
+    "image",
+    "output",
+    "boot_target_device",
+    "boot_migrate_force",
+}
+# Stages of a device, in order; devices without an image stop at READY
+REGISTERED, READY, BAKING, BAKED = "registered", "ready", "baking", "baked"
+# Delays between two polls of the inventory, in seconds
+POLL_DELAY = 5
+POLL_MAX_DELAY = 60
+POLL_RETRIES = 3
+
+
+class EnrollError(Exception):
+    pass
+
+
+class ManifestError(EnrollError):
+    pass
+
+
+def load_manifest(path: "str") -> "list[dict]":
+    """The devices of a manifest, with their defaults and paths resolved."""
+    import yaml
+
+    with open(path) as f:
+        manifest = yaml.safe_load(f) or {}
+    devices = manifest.get("devices") if isinstance(manifest, dict) else None
+    if not isinstance(devices, list):
+        raise ManifestError(f"'{path}' has no list of devices")
+    base = Path(path).parent
+    entries = []
+    defaults = manifest.get("defaults") or {}
+    names, outputs = set(), set()
+    for entry in devices:
+        if isinstance(entry, str):
+            entry = {"name": entry}
+        if not isinstance(entry, dict):
+            raise ManifestError(f"Device {entry!r} is not a name or a mapping")
+        device = dict(defaults, **entry)
+        name = device.get("name")
+        unknown = set(device) - FIELDS
+        if unknown:
+            raise ManifestError(f"Unknown key(s) {', '.join(sorted(unknown))}")
+        if not name or not validate_rfc1123_name(name):
+            raise ManifestError(f"Device name {name!r} must match RFC1123 DNS")
+        if name in names:
+            raise ManifestError(f"Device {name} is listed twice")
+        if device.get("machine_name") not in SUPPORTED_MACHINE_NAMES:
+            raise ManifestError(f"Device {name} has no supported machine_name")
+        if bool(device.get("application_credential_id")) != bool(
+            device.get("application_credential_secret")
+        ):
+            raise ManifestError(
+                f"Device {name} needs both application_credential_id and "
+                "application_credential_secret, or neither"
+            )
+        if device.get("image"):
+            device["image"] = str(base / device["image"])
+            output = device.get("output", "{name}.img").format(name=name)
+            device["output"] = str(base / output)
+            if device["output"] in outputs:
+                raise ManifestError(f"Several devices are baked to {output}")
+            outputs.add(device["output"])
+        names.add(name)
+        entries.append(device)
+    return entries
+
+
+def error_message(ex) -> str:
+    try:
+        return ex.response.json()["error"]
+    except Exception:
+        return str(ex) or type(ex).__name__
+
+
+class Enrollment:
+    """The enrollment of `devices` (see `load_manifest`), through an OpenStack
+    connection and a Doni adapter, recorded in the JSON file `state_path`."""
+
+    def __init__(self, conn, doni, devices, state_path: "str", log=print):
+        self.conn = conn
+        self.doni = doni
+        self.devices = {device["name"]: device for device in devices}
+        self.state_path = state_path
+        self.log = log
+        self.errors = {}
+        try:
+            with open(state_path) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+        if self.state:
+            self.log(f"Resuming the enrollment saved in '{state_path}'")
+
+    def stage(self, name):
+        return self.state.get(name, {}).get("stage")
+
+    def done(self, name):
+        """Whether a device is not registered (after an error) or enrolled."""
+        stage = self.stage(name)
+        return stage in (None, BAKED) or (
+            stage == READY and not self.devices[name].get("image")
+        )
+
+    def update(self, name, **values):
+        self.state.setdefault(name, {}).update(values)
+        write_json_atomic(self.state_path, self.state, indent=2)
+
+    def hardware(self):
+        return self.doni.get(
+            "/v1/hardware/",
+            connect_retries=POLL_RETRIES,
+            status_code_retries=POLL_RETRIES,
+        ).json()["hardware"]
+
+    def register(self, workers=8, rate=None, replace_credentials=False):
+        """Register the devices not registered yet, concurrently."""
+        todo = [name for name in self.devices if not self.stage(name)]
+        if not todo:
+            return
+        # Registered by an enrollment whose state was lost
+        for hardware in self.hardware():
+            name = hardware["name"]
+            if name in todo:
+                todo.remove(name)
+                self.update(name, uuid=hardware["uuid"], stage=REGISTERED)
+                self.log(f"{name} was already registered")
+
+        credentials = {}
+        identity, user_id = self.conn.identity, self.conn.current_user_id
+        # Listed once for all devices
+        if any(not self.devices[n].get("application_credential_id") for n in todo):
+            for credential in identity.application_credentials(user_id):
+                credentials[credential.name] = credential
+
+        def register(name):
+            device = self.devices[name]
+            credential_id = device.get("application_credential_id")
+            secret = device.get("application_credential_secret")
+            if not credential_id:
+                credential_name = f"chi-edge-{name}"
+                if credential_name in credentials:
+                    if not replace_credentials:
+                        raise EnrollError(
+                            f"Application credential '{credential_name}' already "
+                            "exists (see --replace-credentials)"
+                        )
+                    identity.delete_application_credential(
+                        user_id, credentials[credential_name].id
+                    )
+                credential = identity.create_application_credential(
+                    user_id, name=credential_name
+                )
+                credential_id, secret = credential.id, credential.secret
+            properties = {
+                "application_credential_id": credential_id,
+                "application_credential_secret": secret,
+                "contact_email": device.get("contact_email"),
+                "machine_name": device["machine_name"],
+            }
+            return self.doni.post(
+                "/v1/hardware/",
+                json={
+                    "name": name,
+                    "hardware_type": "device.balena",
+                    "properties": properties,
+                },
+            ).json()
+
+        for name, (hardware, error) in zip(
+            todo, run_concurrently(register, todo, workers, rate)
+        ):
+            if error:
+                self.errors[name] = error_message(error)
+                self.log(f"Failed to register {name}: {self.errors[name]}")
+            else:
+                self.update(name, uuid=hardware["uuid"], stage=REGISTERED)
+                self.log(f"Registered {name} ({hardware['uuid']})")
+
+    def wait_and_bake(self, processes=None, timeout=1800):
+        """Poll the registered devices until they are ready, baking the image
+        of each in a process pool as soon as it is."""
+        pending = [name for name in self.devices if not self.done(name)]
+        baking = {}
+        delay, deadline = POLL_DELAY, time.monotonic() + timeout
+        with ProcessPoolExecutor(processes) as pool:
+            while pending:
+                inventory = {hw["uuid"]: hw for hw in self.hardware()}
+                for name in list(pending):
+                    hardware = inventory.get(self.state[name]["uuid"])
+                    if not hardware:
+                        pending.remove(name)
+                        self.errors[name] = "no longer in the inventory"
+                    elif balena_credentials(hardware):
+                        pending.remove(name)
+                        self.ready(name, hardware, pool, baking)
+                self.collect(baking, wait=False)
+                if not pending:
+                    break
+                if time.monotonic() + delay > deadline:
+                    for name in pending:
+                        self.errors[name] = f"not ready after {timeout} s"
+                    break
+                self.log(f"Waiting {delay:g} s for {len(pending)} device(s)")
+                time.sleep(delay)
+                delay = min(delay * 2, POLL_MAX_DELAY)
+            self.collect(baking, wait=True)
+
+    def ready(self, name, hardware, pool, baking):
+        device = self.devices[name]
+        if self.stage(name) == REGISTERED:
+            self.update(name, stage=READY)
+            self.log(f"{name} is ready")
+        if not device.get("image"):
+            return
+        if self.stage(name) == BAKING and os.path.exists(device["output"]):
+            os.unlink(device["output"])  # left by an interrupted bake
+        self.update(name, stage=BAKING, output=device["output"])
+        future = pool.submit(
+            bake_device_image,
+            device["image"],
+            device["output"],
+            hardware,
+            device.get("boot_target_device"),
+            bool(device.get("boot_migrate_force")),
+        )
+        baking[future] = name
+
+    def collect(self, baking, wait):
+        for future in list(baking):
+            if not (wait or future.done()):
+                continue
+            name = baking.pop(future)
+            try:
+                future.result()
+            except Exception as ex:
+                self.errors[name] = error_message(ex)
+                self.log(f"Failed to bake {name}: {self.errors[name]}")
+            else:
+                self.update(name, stage=BAKED)
+                self.log(f"Baked {name} to '{self.devices[name]['output']}'")
+
+    def results(self):
+        """(name, UUID, stage, error) of every device."""
+        return [
+            (
+                name,
+                self.state.get(name, {}).get("uuid"),
+                self.stage(name),
+                self.errors.get(name),
+            )
+            for name in self.devices
+        ]
@@ -1,74 +1,269 @@
 """Utilities for reading and writing to disk image."""
 
+import errno
+import hashlib
 import json
+import os
 
+from chi_edge.utils import load_json_cache, save_json_cache, user_cache_dir
 from chi_edge.vendor.FATtools import Volume
 
+# balenaOS boot partition labels, as reported by FATtools for an 8.3 label
+BOOT_PARTITION_LABELS = ("resin-bo.ot", "flash-bo.ot")
 
-def find_boot_partition_id(image: str):
+# Sectors hashed into an image fingerprint: the MBR, GPT header and GPT entries
+FINGERPRINT_SECTORS = 34
+# Boot partitions located, by image fingerprint, in the user cache directory
+PARTITION_CACHE_FILE = "boot-partitions.json"
+PARTITION_CACHE_SIZE = 64
 
-    # max of 128 gpt partitions possible
-    for partid in range(0, 128):
-        try:
-            part = Volume.vopen(
-                image,
-                mode="r+b",
-                what=f"partition{partid}",
-            )
-            try:
-                partfs = Volume.openvolume(part)
-            except AttributeError:
-                """Sometimes Volume.vopen returns the string 'EINV'"""
-                continue
-        except ZeroDivisionError:
-            pass
-        except FileNotFoundError:
-            raise
-        else:
-            try:
-                part_label = partfs.label()
-            except AttributeError:
-                pass
-            else:
-                if part_label == "resin-bo.ot" or part_label == "flash-bo.ot":
-                    Volume.vclose(part)
-                    return partid
-            Volume.vclose(part)
-    else:
-        raise Exception("Cannot find boot partition")
+# ioctl sharing the extents of a file with another one (Linux: Btrfs, XFS...)
+FICLONE = 0x40049409
+# Bytes transferred at once by a sparse copy
+COPY_CHUNK = 64 << 20
 
 
-def read_config_json(image, partition_id, filename):
-    o = Volume.vopen(image, mode="r+b", what=f"partition{partition_id}")
-    fs = Volume.openvolume(o)
-    f = fs.open(filename)
+class ImageError(Exception):
+    """Raised when a disk image does not have the expected layout."""
+
+
+def list_partitions(image: "str") -> "list[Volume.PartitionInfo]":
+    """Scan the partition table of an image, opening it only once."""
+    return Volume.scan_partitions(image)
+
+
+def image_fingerprint(image: "str") -> str:
+    """Identify the contents of an image by its size, modification time and
+    partition table sectors, without reading the rest of it."""
+    st = os.stat(image)
+    with open(image, "rb") as f:
+        head = f.read(FINGERPRINT_SECTORS * 512)
+    return f"{st.st_size}-{st.st_mtime_ns}-{hashlib.sha256(head).hexdigest()}"
+
+
+def remember_boot_partition(image: "str", part: "Volume.PartitionInfo"):
+    """Record the boot partition of an image under its current fingerprint."""
     try:
-        data = json.load(f)
-    except json.JSONDecodeError:
-        raise
-    finally:
-        f.close()
-        fs.close()
-        o.close()
+        key = image_fingerprint(image)
+    except OSError:
+        return
+    cache = load_json_cache(PARTITION_CACHE_FILE)
+    cache.pop(key, None)  # most recently used last
+    cache[key] = part._asdict()
+    for old in list(cache)[:-PARTITION_CACHE_SIZE]:
+        del cache[old]
+    save_json_cache(PARTITION_CACHE_FILE, cache)
 
-    return data
 
+def clear_partition_cache():
+    """Forget all the boot partitions located so far."""
+    try:
+        (user_cache_dir() / PARTITION_CACHE_FILE).unlink()
+    except FileNotFoundError:
+        pass
 
-def write_config_json(image, partition_id, filename, configdata):
-    o = Volume.vopen(image, mode="r+b", what=f"partition{partition_id}")
-    fs = Volume.openvolume(o)
+
+def _reflink(src_fd, dst_fd) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
     try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError:
+        return False
+    return True
+
+
+def _data_extents(fd, size):
+    """Yield the (offset, length) extents holding data in a file, or the whole
+    file if holes cannot be found."""
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:  # only a hole is left
+                return
+            if pos == 0:  # not supported by the file system
+                yield 0, size
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end - start
+        pos = end
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    while length:
+        n = min(length, COPY_CHUNK)
+        try:
+            done = os.copy_file_range(src_fd, dst_fd, n, offset, offset)
+        except (AttributeError, OSError):
+            done = os.pwrite(dst_fd, os.pread(src_fd, n, offset), offset)
+        if not done:
+            raise ImageError("Unexpected end of file while copying image")
+        offset += done
+        length -= done
+
+
+def _clone(src_fd, dst_fd) -> str:
+    if _reflink(src_fd, dst_fd):
+        return "reflink"
+    size = os.fstat(src_fd).st_size
+    os.ftruncate(dst_fd, size)
+    for offset, length in _data_extents(src_fd, size):
+        _copy_range(src_fd, dst_fd, offset, length)
+    return "sparse"
+
+
+def clone_image(src: "str", dst: "str") -> str:
+    """Copy an image to a new file, without writing its unallocated ranges.
+
+    The copy shares the blocks of `src` where the file system allows it
+    (reflink); otherwise only the data extents are copied and holes are kept.
+    Returns "reflink" or "sparse", the method used.
+    """
+    with open(src, "rb") as fsrc:
+        fdst = open(dst, "xb")
+        try:
+            with fdst:
+                return _clone(fsrc.fileno(), fdst.fileno())
+        except BaseException:
+            os.unlink(dst)
+            raise
+
+
+def find_boot_partition(image: "str", cache=True) -> "Volume.PartitionInfo":
+    """Locate the balenaOS boot partition of an image.
+
+    With `cache`, a partition located before in an image with the same
+    fingerprint is returned without parsing the partition table again.
+    """
+    if cache:
+        try:
+            entry = load_json_cache(PARTITION_CACHE_FILE).get(image_fingerprint(image))
+        except OSError:
+            entry = None
+        if entry:
+            return Volume.PartitionInfo(**entry)
+    for part in list_partitions(image):
+        if part.label in BOOT_PARTITION_LABELS:
+            if cache:
+                remember_boot_partition(image, part)
+            return part
+    raise ImageError("Cannot find boot partition")
+
+
+def find_boot_partition_id(image: "str") -> int:
+    return find_boot_partition(image).index
+
+
+def _open_partition(image, partition, mode):
+    """Open the file system on a partition.
+
+    `partition` is either a `PartitionInfo` (as returned by
+    `find_boot_partition`) or a partition index from `list_partitions`.
+    """
+    if not isinstance(partition, Volume.PartitionInfo):
+        matches = [p for p in list_partitions(image) if p.index == partition]
+        if not matches:
+            raise ImageError(f"Cannot find partition {partition}")
+        partition = matches[0]
+    part = Volume.vopen(
+        image, mode=mode, what="partition", offset=partition.offset, size=partition.size
+    )
+    fs = Volume.openvolume(part)
+    if fs == "EINV":
+        Volume.vclose(part)
+        raise ImageError(f"Cannot open file system on partition {partition.index}")
+    return part, fs
+
+
+class BootPartition:
+    """A session on the file system of an image partition, mounted only once.
+
+    Use it as a context manager: files are read and written through the same
+    volume handle, and the image is flushed and closed once on exit. If
+    `partition` is not given, the balenaOS boot partition is looked up, using
+    the partition cache unless `cache` is false.
+    """
+
+    def __init__(self, image, partition=None, mode="r+b", cache=True):
+        self.image = image
+        self.partition = partition
+        self.mode = mode
+        self.cache = cache
+        self._located = False
+        self._part = None
+        self._fs = None
+
+    def __enter__(self) -> "BootPartition":
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        if self.partition is None:
+            self.partition = find_boot_partition(self.image, self.cache)
+            self._located = True
+        self._part, self._fs = _open_partition(self.image, self.partition, self.mode)
+
+    def close(self):
+        if self._fs is None:
+            return
+        try:
+            self._fs.close()
+        finally:
+            Volume.vclose(self._part)
+            self._part = self._fs = None
+        if self._located and self.cache and self.mode != "rb":
+            # Writing changed the fingerprint: keep the image known
+            remember_boot_partition(self.image, self.partition)
+
+    def read_json(self, filename):
+        f = self._fs.open(filename)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def write_json(self, filename, data, verify=True):
+        """Write `data` as JSON to `filename`, replacing it.
+
+        With `verify`, the disk cache is flushed and emptied, then the file is
+        read back through the same volume and compared with `data`.
+        """
         # we need to write bytes, use fattools write method
         json_str = json.dumps(
-            obj=configdata,
+            obj=data,
             indent=2,
         )
-        f = fs.create(filename)
-        f.write(json_str.encode("utf-8"))
-        fs.flush()
-    except json.JSONDecodeError:
-        raise
-    finally:
-        f.close()
-        fs.close()
-        o.close()
+        f = self._fs.create(filename)
+        try:
+            f.write(json_str.encode("utf-8"))
+        finally:
+            f.close()
+        self._fs.flush()
+        if not verify:
+            return
+        disk = getattr(self._part, "disk", self._part)
+        if hasattr(disk, "cache_setup"):
+            disk.cache_setup()  # reads back from the image, not from the cache
+        if self.read_json(filename) != data:
+            raise ImageError(f"Written {filename} does not match")
+
+
+def read_config_json(image, partition_id, filename):
+    with BootPartition(image, partition_id, "rb") as boot:
+        return boot.read_json(filename)
+
+
+def write_config_json(image, partition_id, filename, configdata):
+    with BootPartition(image, partition_id) as boot:
+        boot.write_json(filename, configdata, verify=False)
@@ -0,0 +1,132 @@
+"""Overlays: the changes made by a bake, kept apart from the base image.
+
+An overlay file starts with a header holding the SHA-256 digest and the size
+of the raw base image, followed by the changed extents as (offset, length,
+data) records. Applying it to the same base image gives the baked image.
+"""
+
+import hashlib
+import os
+import struct
+from collections import namedtuple
+
+from chi_edge.image import ImageError, clone_image, image_fingerprint
+from chi_edge.utils import load_json_cache, save_json_cache
+from chi_edge.vendor.FATtools import disk
+
+MAGIC = b"CHIEOVL1"
+HEADER = struct.Struct("<8s32sQI")  # magic, base digest, base size, extents
+EXTENT = struct.Struct("<QI")  # offset, length
+# Digests of base images, by image fingerprint, in the user cache directory
+DIGEST_CACHE_FILE = "base-digests.json"
+DIGEST_CACHE_SIZE = 64
+CHUNK = 1 << 20
+
+Overlay = namedtuple("Overlay", "digest size extents")
+
+
+def base_digest(image: "str") -> bytes:
+    """SHA-256 digest of a base image, computed once per image fingerprint."""
+    key = image_fingerprint(image)
+    cache = load_json_cache(DIGEST_CACHE_FILE)
+    if key in cache:
+        return bytes.fromhex(cache[key])
+    h = hashlib.sha256()
+    with open(image, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK), b""):
+            h.update(chunk)
+    cache[key] = h.hexdigest()
+    for old in list(cache)[:-DIGEST_CACHE_SIZE]:
+        del cache[old]
+    save_json_cache(DIGEST_CACHE_FILE, cache)
+    return h.digest()
+
+
+def open_overlay_disk(base: "str") -> "disk.overlay_disk":
+    """Open a raw base image read-only: what is written to it is collected as
+    extents, returned by its `extents()` method, instead of being written."""
+    return disk.overlay_disk(base)
+
+
+def write_overlay(path: "str", base: "str", extents):
+    """Save the (offset, data) extents changed in `base` to a new overlay file."""
+    with open(path, "xb") as f:
+        f.write(
+            HEADER.pack(MAGIC, base_digest(base), os.path.getsize(base), len(extents))
+        )
+        for offset, data in extents:
+            f.write(EXTENT.pack(offset, len(data)))
+            f.write(data)
+
+
+def read_overlay(path: "str") -> "Overlay":
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or not header.startswith(MAGIC):
+            raise ImageError(f"'{path}' is not an overlay file")
+        _, digest, size, count = HEADER.unpack(header)
+        extents = []
+        for _ in range(count):
+            record = f.read(EXTENT.size)
+            offset, length = EXTENT.unpack(record.ljust(EXTENT.size, b"\0"))
+            data = f.read(length)
+            if len(record) < EXTENT.size or len(data) < length:
+                raise ImageError(f"Overlay file '{path}' is truncated")
+            extents.append((offset, data))
+    return Overlay(digest, size, sorted(extents))
+
+
+def _check_base(base, overlay):
+    if os.path.getsize(base) != overlay.size:
+        raise ImageError(
+            f"'{base}' is not the base image of this overlay (size differs)"
+        )
+
+
+def apply_overlay(base: "str", overlay: "Overlay", target: "str") -> str:
+    """Write the baked image to a new file `target`: a clone of the base image
+    (see `clone_image`) patched with the overlay. Returns the clone method."""
+    _check_base(base, overlay)
+    if base_digest(base) != overlay.digest:
+        raise ImageError(f"'{base}' is not the base image of this overlay")
+    method = clone_image(base, target)
+    try:
+        with open(target, "r+b") as f:
+            for offset, data in overlay.extents:
+                f.seek(offset)
+                f.write(data)
+    except BaseException:
+        os.unlink(target)
+        raise
+    return method
+
+
+def stream_overlay(base: "str", overlay: "Overlay", out):
+    """Write the baked image to the binary stream `out`, in one pass over the
+    base image. The base is checked first, like in `apply_overlay`: if it is
+    not the overlay's base, ImageError is raised before anything is written.
+    """
+    _check_base(base, overlay)
+    if base_digest(base) != overlay.digest:
+        raise ImageError(f"'{base}' is not the base image of this overlay")
+    extents = overlay.extents
+    k = 0  # first extent not yet fully written
+    buf = bytearray(CHUNK)
+    mv = memoryview(buf)
+    pos = 0
+    with open(base, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            j = k
+            while j < len(extents) and extents[j][0] < pos + n:
+                offset, data = extents[j]
+                lo, hi = max(offset, pos), min(offset + len(data), pos + n)
+                if lo < hi:
+                    mv[lo - pos : hi - pos] = data[lo - offset : hi - offset]
+                if offset + len(data) <= pos + n:
+                    k = j + 1
+                j += 1
+            out.write(mv[:n])
+            pos += n
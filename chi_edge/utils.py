@@ -1,4 +1,9 @@
+import json
+import os
 import re
+import tempfile
+from datetime import datetime
+from pathlib import Path
 
 
 def validate_rfc1123_name(name) -> bool:
@@ -19,3 +24,61 @@ def validate_rfc1123_name(name) -> bool:
     rfc1123_dns_subdomain_regex_string = r"^[a-z0-9][a-z0-9-.]{0,253}[a-z0-9]$"
     name_match = re.match(rfc1123_dns_subdomain_regex_string, name)
     return bool(name_match)
+
+
+def parse_date(utc_datestr):
+    parsed_date = datetime.strptime(utc_datestr, "%Y-%m-%dT%H:%M:%S+00:00")
+    return parsed_date
+
+
+def user_cache_dir() -> "Path":
+    """
+    Directory for chi-edge's on-disk caches: $CHI_EDGE_CACHE_DIR if set, else
+    `chi-edge` under $XDG_CACHE_HOME (~/.cache by default). It may not exist yet.
+    """
+    if os.environ.get("CHI_EDGE_CACHE_DIR"):
+        return Path(os.environ["CHI_EDGE_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "chi-edge"
+
+
+def load_json_cache(name) -> dict:
+    """
+    Load the JSON object cached in file `name` of the user cache directory.
+    Returns an empty dict if the file is missing or unreadable.
+    """
+    try:
+        with open(user_cache_dir() / name) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_json_atomic(path, obj, indent=None):
+    """
+    Atomically replace file `path` with the JSON encoding of `obj`: readers
+    see either the previous file or the new one, never a partial write.
+    """
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(obj, f, indent=indent)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def save_json_cache(name, cache: dict):
+    """
+    Atomically replace file `name` of the user cache directory with `cache`.
+    Failures are ignored: caches are only an optimization.
+    """
+    path = user_cache_dir() / name
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(path, cache)
+    except OSError:
+        pass
@@ -0,0 +1,345 @@
+"""Builders for small synthetic disk images used by the image tests."""
+
+import json
+import struct
+from io import BytesIO
+
+from chi_edge.vendor.FATtools import Volume, disk
+
+SECTOR = 512
+
+
+def _boot_sector(
+    fstype, total_sectors, sectors_per_cluster, sectors_per_fat, root_entries, label
+):
+    bs = bytearray(SECTOR)
+    bs[0:3] = b"\xeb\x3c\x90"
+    bs[3:11] = b"MSWIN4.1"
+    struct.pack_into("<HBH", bs, 0x0B, SECTOR, sectors_per_cluster, 32)
+    bs[0x10] = 2  # FAT copies
+    bs[0x15] = 0xF8  # fixed disk
+    struct.pack_into("<I", bs, 0x20, total_sectors)
+    if fstype == "FAT32":
+        struct.pack_into("<I", bs, 0x24, sectors_per_fat)
+        struct.pack_into("<IHH", bs, 0x2C, 2, 1, 6)  # root cluster, FSInfo, backup
+        bs[0x42] = 0x29
+        bs[0x47:0x52] = label.ljust(11).encode("ascii")
+        bs[0x52:0x5A] = b"FAT32   "
+    else:
+        struct.pack_into("<H", bs, 0x11, root_entries)
+        struct.pack_into("<H", bs, 0x16, sectors_per_fat)
+        bs[0x26] = 0x29
+        bs[0x2B:0x36] = label.ljust(11).encode("ascii")
+        bs[0x36:0x3E] = fstype.ljust(8).encode("ascii")
+    bs[0x1FE:0x200] = b"\x55\xaa"
+    return bs
+
+
+def _fsinfo_sector(free_clusters, next_free=3):
+    fsi = bytearray(SECTOR)
+    fsi[0:4] = b"RRaA"
+    fsi[0x1E4:0x1E8] = b"rrAa"
+    struct.pack_into("<II", fsi, 0x1E8, free_clusters, next_free)
+    fsi[0x1FE:0x200] = b"\x55\xaa"
+    return fsi
+
+
+def make_fat_volume(size, fstype="FAT16", label="resin-boot", sectors_per_cluster=4):
+    """Returns a bytearray holding a blank FAT12/16/32 volume of `size` bytes.
+
+    The volume label is written both in the boot sector and as a root directory
+    entry, lower-cased like balenaOS does, so that FATtools reports it as an 8.3
+    name (e.g. "resin-bo.ot").
+    """
+    total = size // SECTOR
+    reserved = 32
+    bits = {"FAT12": 12, "FAT16": 16, "FAT32": 32}[fstype]
+    # FATtools tells FAT12 from FAT16 by the root directory size
+    root_entries = {"FAT12": 224, "FAT16": 512, "FAT32": 0}[fstype]
+    root_sectors = root_entries * 32 // SECTOR
+    # Iterate once to get a FAT big enough for the clusters it describes
+    spf = 1
+    while True:
+        data = total - reserved - 2 * spf - root_sectors
+        clusters = data // sectors_per_cluster
+        need = ((clusters + 2) * bits + 7) // 8
+        if (need + SECTOR - 1) // SECTOR <= spf:
+            break
+        spf += 1
+    vol = bytearray(size)
+    vol[0:SECTOR] = _boot_sector(
+        fstype, total, sectors_per_cluster, spf, root_entries, label
+    )
+    for copy in range(2):
+        fat = (reserved + copy * spf) * SECTOR
+        if fstype == "FAT12":
+            vol[fat : fat + 3] = b"\xf8\xff\xff"
+        elif fstype == "FAT16":
+            vol[fat : fat + 4] = b"\xf8\xff\xff\xff"
+        else:
+            # Media, reserved and the root directory cluster (end of chain)
+            vol[fat : fat + 12] = struct.pack(
+                "<III", 0x0FFFFFF8, 0x0FFFFFFF, 0x0FFFFFFF
+            )
+    root = (reserved + 2 * spf) * SECTOR
+    entry = bytearray(32)
+    entry[0:11] = label.ljust(11)[:11].encode("ascii")
+    entry[0x0B] = 0x08
+    vol[root : root + 32] = entry
+    if fstype == "FAT32":
+        vol[SECTOR : 2 * SECTOR] = _fsinfo_sector(clusters - 1)
+    return vol
+
+
+def _upcase_table():
+    """A compressed exFAT up-case table mapping the ASCII letters only: runs
+    of identity mappings are written as 0xFFFF and their length."""
+    table = struct.pack("<HH", 0xFFFF, ord("a"))
+    table += struct.pack("<26H", *range(ord("A"), ord("Z") + 1))
+    table += struct.pack("<HH", 0xFFFF, 0x10000 - ord("z") - 1)
+    return table
+
+
+def _vbr_checksum(sectors):
+    checksum = 0
+    for i, b in enumerate(sectors):
+        if i in (106, 107, 112):  # VolumeFlags and PercentInUse
+            continue
+        checksum = ((checksum << 31) | (checksum >> 1)) + b & 0xFFFFFFFF
+    return checksum
+
+
+def make_exfat_volume(size, label="resin-boot", sectors_per_cluster=8):
+    """Returns a bytearray holding a blank exFAT volume of `size` bytes.
+
+    The cluster heap starts with the allocation bitmap, the up-case table and
+    the root directory, each in its own FAT chain. The root directory holds
+    their entries and the volume label.
+    """
+    total = size // SECTOR
+    fat_offset = 32  # past the main and backup boot regions
+    cluster = sectors_per_cluster * SECTOR
+    fat_length = ((total // sectors_per_cluster + 2) * 4 + SECTOR - 1) // SECTOR
+    heap_offset = fat_offset + fat_length
+    clusters = (total - heap_offset) // sectors_per_cluster
+    bitmap_size = (clusters + 7) // 8
+    upcase = _upcase_table()
+    # Bitmap, up-case table and root directory, in this order from cluster #2
+    chains = []
+    first = 2
+    for length in (bitmap_size, len(upcase), cluster):
+        count = (length + cluster - 1) // cluster
+        chains.append((first, count))
+        first += count
+    root = chains[2][0]
+
+    vol = bytearray(size)
+    bs = bytearray(SECTOR)
+    bs[0:3] = b"\xeb\x76\x90"
+    bs[3:11] = b"EXFAT   "
+    struct.pack_into(
+        "<QQIIIIIIHHBBBBB",
+        bs,
+        0x40,
+        0,
+        total,
+        fat_offset,
+        fat_length,
+        heap_offset,
+        clusters,
+        root,
+        0x1234ABCD,  # serial
+        0x100,  # revision 1.00
+        0,
+        9,
+        sectors_per_cluster.bit_length() - 1,
+        1,  # FAT copies
+        0x80,
+        0,
+    )
+    bs[0x1FE:0x200] = b"\x55\xaa"
+    vbr = bytearray(12 * SECTOR)
+    vbr[0:SECTOR] = bs
+    for i in range(1, 9):  # extended boot sectors
+        vbr[(i + 1) * SECTOR - 4 : (i + 1) * SECTOR] = b"\x00\x00\x55\xaa"
+    checksum = _vbr_checksum(vbr[: 11 * SECTOR])
+    vbr[11 * SECTOR :] = struct.pack("<I", checksum) * (SECTOR // 4)
+    vol[0 : 12 * SECTOR] = vbr
+    vol[12 * SECTOR : 24 * SECTOR] = vbr  # backup
+
+    fat = fat_offset * SECTOR
+    struct.pack_into("<II", vol, fat, 0xFFFFFFF8, 0xFFFFFFFF)
+    for start, count in chains:
+        for c in range(start, start + count):
+            nxt = c + 1 if c + 1 < start + count else 0xFFFFFFFF
+            struct.pack_into("<I", vol, fat + 4 * c, nxt)
+
+    def heap(c):
+        return (heap_offset + (c - 2) * sectors_per_cluster) * SECTOR
+
+    used = first - 2
+    bitmap = bytearray(bitmap_size)
+    bitmap[: used // 8] = b"\xff" * (used // 8)
+    if used % 8:
+        bitmap[used // 8] = (1 << used % 8) - 1
+    vol[heap(chains[0][0]) : heap(chains[0][0]) + bitmap_size] = bitmap
+    vol[heap(chains[1][0]) : heap(chains[1][0]) + len(upcase)] = upcase
+
+    name = label.encode("utf-16le")
+    entries = struct.pack("<BB22s8x", 0x83, len(label), name)
+    entries += struct.pack("<BB18xIQ", 0x81, 0, chains[0][0], bitmap_size)
+    upcase_checksum = 0
+    for b in upcase:
+        upcase_checksum = ((upcase_checksum << 31) | (upcase_checksum >> 1)) + b
+        upcase_checksum &= 0xFFFFFFFF
+    entries += struct.pack(
+        "<B3xI12xIQ", 0x82, upcase_checksum, chains[1][0], len(upcase)
+    )
+    vol[heap(root) : heap(root) + len(entries)] = entries
+    return vol
+
+
+def make_disk_image(
+    path=None,
+    fstype="FAT16",
+    label="resin-boot",
+    config=None,
+    boot_size=16 << 20,
+    gpt=False,
+    extra_partitions=1,
+):
+    """Builds a partitioned disk image with a FAT boot partition (or exFAT,
+    with `fstype="EXFAT"`).
+
+    The boot partition holds `config` as `config.json` when given. Extra
+    partitions are left unformatted, like balenaOS root/data partitions are
+    from FATtools' point of view. Returns the image path, or a BytesIO if no
+    path was given.
+    """
+    start = 1 << 20
+    extra_size = 1 << 20
+    size = start + boot_size + extra_partitions * extra_size + (1 << 20)
+    img = bytearray(size)
+    if fstype == "EXFAT":
+        img[start : start + boot_size] = make_exfat_volume(boot_size, label)
+    else:
+        img[start : start + boot_size] = make_fat_volume(boot_size, fstype, label)
+    if gpt:
+        _write_gpt(img, start, boot_size, extra_partitions, extra_size)
+    else:
+        _write_mbr(img, start, boot_size, extra_partitions, extra_size)
+    if path is None:
+        stream = BytesIO(img)
+        if config is not None:
+            _write_config(stream, config)
+        return stream
+    with open(path, "wb") as f:
+        f.write(img)
+    if config is not None:
+        _write_config(str(path), config)
+    return path
+
+
+def _write_config(image, config):
+    part = Volume.vopen(image, "r+b", "partition0")
+    fs = Volume.openvolume(part)
+    f = fs.create("config.json")
+    f.write(json.dumps(config).encode("utf-8"))
+    f.close()
+    fs.close()
+    part.close()
+    if isinstance(part.disk, disk.disk) and not isinstance(image, BytesIO):
+        part.disk.close()
+
+
+def _mbr_entry(ptype, start, size):
+    return struct.pack(
+        "<B3sB3sII",
+        0,
+        b"\xfe\xff\xff",
+        ptype,
+        b"\xfe\xff\xff",
+        start // SECTOR,
+        size // SECTOR,
+    )
+
+
+def _write_mbr(img, start, boot_size, extra, extra_size):
+    """Writes an MBR; beyond two extra primaries, slot 3 becomes an extended
+    partition holding the rest as logical partitions, like balenaOS does."""
+    mbr = bytearray(SECTOR)
+    mbr[0x1BE:0x1CE] = _mbr_entry(0x0C, start, boot_size)
+    offset = start + boot_size
+    primaries = extra if extra <= 3 else 2
+    for i in range(primaries):
+        e = 0x1CE + 16 * i
+        mbr[e : e + 16] = _mbr_entry(0x83, offset, extra_size)
+        offset += extra_size
+    logicals = extra - primaries
+    if logicals:
+        base = offset
+        mbr[0x1EE:0x1FE] = _mbr_entry(0x0F, base, logicals * extra_size)
+        for i in range(logicals):
+            # Each EBR sits right before its logical partition
+            ebr = bytearray(SECTOR)
+            ebr[0x1BE:0x1CE] = _mbr_entry(0x83, SECTOR, extra_size - SECTOR)
+            if i + 1 < logicals:
+                ebr[0x1CE:0x1DE] = _mbr_entry(
+                    0x05, offset + extra_size - base, extra_size
+                )
+            ebr[0x1FE:0x200] = b"\x55\xaa"
+            img[offset : offset + SECTOR] = ebr
+            offset += extra_size
+    mbr[0x1FE:0x200] = b"\x55\xaa"
+    img[0:SECTOR] = mbr
+
+
+def _write_gpt(img, start, boot_size, extra, extra_size):
+    import uuid
+    import zlib
+
+    mbr = bytearray(SECTOR)
+    mbr[0x1BE:0x1CE] = _mbr_entry(0xEE, SECTOR, 0xFFFFFFFF * SECTOR)
+    mbr[0x1FE:0x200] = b"\x55\xaa"
+    img[0:SECTOR] = mbr
+    entries = bytearray(128 * 128)
+    basic = uuid.UUID("EBD0A0A2-B9E5-4433-87C0-68B6B72699C7").bytes_le
+    linux = uuid.UUID("0FC63DAF-8483-4772-8E79-3D69D8477DE4").bytes_le
+    parts = [(basic, start, boot_size)]
+    offset = start + boot_size
+    for _ in range(extra):
+        parts.append((linux, offset, extra_size))
+        offset += extra_size
+    for i, (ptype, pstart, psize) in enumerate(parts):
+        struct.pack_into(
+            "<16s16sQQ",
+            entries,
+            128 * i,
+            ptype,
+            uuid.uuid4().bytes_le,
+            pstart // SECTOR,
+            (pstart + psize) // SECTOR - 1,
+        )
+    hdr = bytearray(SECTOR)
+    struct.pack_into(
+        "<8sIIIIQQQQ16sQIII",
+        hdr,
+        0,
+        b"EFI PART",
+        0x10000,
+        92,
+        0,
+        0,
+        1,
+        len(img) // SECTOR - 1,
+        34,
+        len(img) // SECTOR - 34,
+        uuid.uuid4().bytes_le,
+        2,
+        128,
+        128,
+        zlib.crc32(entries),
+    )
+    struct.pack_into("<I", hdr, 0x10, zlib.crc32(hdr[:92]))
+    img[SECTOR : 2 * SECTOR] = hdr
+    img[2 * SECTOR : 2 * SECTOR + len(entries)] = entries
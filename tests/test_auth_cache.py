@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+from keystoneauth1 import session
+from keystoneauth1.identity import v3
+
+from chi_edge import auth_cache
+from chi_edge.cli import cli
+
+
+class Keystone(BaseHTTPRequestHandler):
+    """Issues tokens, and serves an empty Doni inventory to valid tokens."""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server.requests.append(("POST", self.path))
+        token = uuid.uuid4().hex
+        server.tokens.add(token)
+        now = datetime.now(timezone.utc)
+        expires = now + server.token_life
+        endpoint = {"id": "e", "interface": "public", "region": "r", "region_id": "r"}
+        endpoint["url"] = f"http://127.0.0.1:{server.server_port}/inventory"
+        user = {"id": "u", "name": "user", "domain": {"id": "default", "name": "d"}}
+        body = {
+            "token": {
+                "methods": ["password"],
+                "expires_at": expires.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+                "issued_at": now.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+                "user": user,
+                "project": {"id": "p", "name": "proj", "domain": user["domain"]},
+                "catalog": [{"id": "s", "type": "inventory", "endpoints": [endpoint]}],
+            }
+        }
+        self.reply(201, body, [("X-Subject-Token", token)])
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        if self.headers.get("X-Auth-Token") not in self.server.tokens:
+            self.reply(401, {"error": "unauthorized"})
+        else:
+            self.reply(200, {"hardware": []})
+
+
+@pytest.fixture
+def keystone():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Keystone)
+    server.requests = []
+    server.tokens = set()
+    server.token_life = timedelta(hours=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHI_EDGE_CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def connect(server, password="secret"):
+    auth = v3.Password(
+        auth_url=f"http://127.0.0.1:{server.server_port}/v3",
+        username="user",
+        password=password,
+        user_domain_id="default",
+        project_id="p",
+    )
+    return SimpleNamespace(session=session.Session(auth=auth))
+
+
+def list_devices(server, *args):
+    with patch("chi_edge.cli.openstack") as mock_os:
+        mock_os.connect.side_effect = lambda cloud: connect(server)
+        result = CliRunner().invoke(cli, [*args, "device", "list"])
+    assert result.exit_code == 0, result.output
+    requests, server.requests = server.requests, []
+    return requests
+
+
+def test_auth_cache(keystone, cache_dir):
+    token = ("POST", "/v3/auth/tokens")
+    hardware = ("GET", "/inventory/v1/hardware/")
+    assert list_devices(keystone, "--auth-cache") == [token, hardware]
+    assert os.stat(cache_dir / auth_cache.AUTH_CACHE_FILE).st_mode & 0o777 == 0o600
+    # Later invocations are a single round trip
+    assert list_devices(keystone, "--auth-cache") == [hardware]
+    assert list_devices(keystone, "--auth-cache") == [hardware]
+    assert list_devices(keystone) == [token, hardware]
+
+    # A revoked token is replaced, and the new one cached
+    keystone.tokens.clear()
+    assert list_devices(keystone, "--auth-cache") == [hardware, token, hardware]
+    assert list_devices(keystone, "--auth-cache") == [hardware]
+
+
+def test_auth_cache_keys(keystone):
+    conn = connect(keystone)
+    conn.session.get_token()
+    auth_cache.save_auth_state("edge", conn.session.auth)
+    assert auth_cache.load_auth_state("edge", connect(keystone).session.auth)
+    assert not auth_cache.load_auth_state("other", connect(keystone).session.auth)
+    assert not auth_cache.load_auth_state("edge", connect(keystone, "x").session.auth)
+
+    # Tokens about to expire are not reused
+    keystone.token_life = timedelta(seconds=auth_cache.MIN_TOKEN_LIFE - 10)
+    conn = connect(keystone)
+    conn.session.get_token()
+    auth_cache.save_auth_state("short", conn.session.auth)
+    assert not auth_cache.load_auth_state("short", connect(keystone).session.auth)
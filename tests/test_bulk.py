@@ -0,0 +1,222 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+from keystoneauth1 import noauth, session
+from rich.console import Console
+
+from chi_edge import bulk, device_index
+from chi_edge.cli import cli
+from chi_edge.utils import load_json_cache
+
+
+class Inventory(BaseHTTPRequestHandler):
+    """A stand-in for the Doni hardware API, answering slowly."""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_one_request(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            super().handle_one_request()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def device(self):
+        self.server.requests.append((self.command, self.path))
+        time.sleep(0.02)
+        parts = self.path.strip("/").split("/")
+        device = self.server.devices.get(parts[2])
+        if not device:
+            self.reply(404, {"error": f"Hardware {parts[2]} could not be found."})
+        elif self.server.unavailable.pop(device["uuid"], None):
+            self.reply(503, {"error": "try again"})
+        elif device["uuid"] in self.server.locked:
+            self.reply(409, {"error": "Hardware is locked."})
+        else:
+            return device
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        self.reply(200, {"hardware": list(self.server.devices.values())})
+
+    def do_POST(self):
+        if self.device():
+            self.reply(202, {})
+
+    def do_PATCH(self):
+        ops = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        device = self.device()
+        if device:
+            for op in ops:
+                device["properties"][op["path"].split("/")[-1]] = op["value"]
+            self.reply(200, device)
+
+    def do_DELETE(self):
+        device = self.device()
+        if device:
+            del self.server.devices[device["uuid"]]
+            self.reply(204)
+
+
+@pytest.fixture
+def inventory():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Inventory)
+    server.lock = threading.Lock()
+    server.in_flight = server.max_in_flight = 0
+    server.requests = []
+    server.unavailable = {}
+    server.locked = set()
+    server.devices = {}
+    for i in range(12):
+        machine = ("raspberrypi4-64", "raspberrypi5")[i % 2]
+        device = {"name": f"dev-{i:02}", "uuid": str(uuid.uuid4())}
+        device["properties"] = {"machine_name": machine}
+        server.devices[device["uuid"]] = device
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHI_EDGE_CACHE_DIR", str(tmp_path / "cache"))
+
+
+def invoke(server, *args, input=None):
+    endpoint = f"http://127.0.0.1:{server.server_port}"
+    connections = []
+
+    def connect(cloud):
+        connections.append(cloud)
+        auth = noauth.NoAuth(endpoint=endpoint)
+        return SimpleNamespace(session=session.Session(auth=auth))
+
+    with (
+        patch("chi_edge.cli.openstack") as mock_os,
+        patch("chi_edge.cli.console", Console(width=300)),
+    ):
+        mock_os.connect.side_effect = connect
+        result = CliRunner().invoke(cli, ["device", *args], input=input)
+    assert len(connections) == 1
+    return result
+
+
+def test_bulk_sync_all(inventory, monkeypatch):
+    # The retry is logged; with live logging, that would swap sys.stdout away
+    # from the CliRunner
+    monkeypatch.setattr(logging.getLogger("keystoneauth.session"), "disabled", True)
+    first = next(iter(inventory.devices))
+    inventory.unavailable[first] = True
+    result = invoke(inventory, "sync", "--all", "--concurrency", "4", "--rate", "1000")
+    assert result.exit_code == 0, result.output
+    assert "Successfully processed 12 device(s)" in result.output
+    syncs = [path for method, path in inventory.requests if method == "POST"]
+    # Every device once, and the unavailable one once more
+    assert sorted(syncs) == sorted(
+        [f"/v1/hardware/{u}/sync/" for u in inventory.devices]
+        + [f"/v1/hardware/{first}/sync/"]
+    )
+    assert inventory.requests.count(("GET", "/v1/hardware/")) == 1
+    assert 1 < inventory.max_in_flight <= 4
+
+
+def test_bulk_set_selector(inventory):
+    result = invoke(
+        inventory,
+        "set",
+        "--selector",
+        "machine_name=raspberrypi5",
+        "--authorized-projects",
+        "proj-a,proj-b",
+        "--rate",
+        "1000",
+    )
+    assert result.exit_code == 0, result.output
+    for device in inventory.devices.values():
+        projects = device["properties"].get("authorized_projects")
+        if device["properties"]["machine_name"] == "raspberrypi5":
+            assert projects == ["proj-a", "proj-b"]
+        else:
+            assert projects is None
+
+
+def test_bulk_delete_errors(inventory):
+    uuids = list(inventory.devices)
+    gone = str(uuid.uuid4())
+    result = invoke(
+        inventory,
+        "delete",
+        "dev-00",
+        uuids[1],
+        gone,
+        "--from-file",
+        "-",
+        "--yes-i-really-really-mean-it",
+        input="# devices to retire\ndev-02\nno-such-device\n\ndev-00\n",
+    )
+    assert result.exit_code != 0
+    assert "2 of 5 device(s) failed" in result.output
+    assert "not found" in result.output
+    assert f"Hardware {gone} could not be found." in result.output
+    assert sorted(inventory.devices) == sorted(uuids[3:])
+
+
+def test_bulk_delete_index(inventory):
+    names = {d["name"]: u for u, d in inventory.devices.items()}
+    inventory.locked.add(names["dev-03"])
+    result = invoke(
+        inventory, "delete", "--all", "--rate", "1000", "--yes-i-really-really-mean-it"
+    )
+    assert result.exit_code != 0
+    assert "1 of 12 device(s) failed" in result.output
+    assert "Hardware is locked." in result.output
+    # Only the device still registered is left in the index
+    (scope,) = load_json_cache(device_index.DEVICE_INDEX_FILE)
+    assert {name: device_index.lookup(scope, name) for name in names} == {
+        name: uuid if name == "dev-03" else None for name, uuid in names.items()
+    }
+
+
+def test_bulk_requires_devices():
+    with patch("chi_edge.cli.openstack") as mock_os:
+        result = CliRunner().invoke(cli, ["device", "sync"])
+    assert result.exit_code != 0
+    assert "Missing DEVICES" in result.output
+    mock_os.connect.assert_not_called()
+
+
+def test_run_concurrently():
+    def call(i):
+        if i == 3:
+            raise ValueError(i)
+        time.sleep(0.01)
+        return i * 2
+
+    start = time.monotonic()
+    results = bulk.run_concurrently(call, range(6), workers=3, rate=50)
+    assert time.monotonic() - start >= 0.1
+    assert [result for result, _ in results] == [0, 2, 4, None, 8, 10]
+    assert isinstance(results[3][1], ValueError)
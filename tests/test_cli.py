@@ -1,6 +1,8 @@
 from unittest.mock import patch, MagicMock
 
+import pytest
 from click.testing import CliRunner
+from keystoneauth1 import exceptions as ksa_exc
 from rich.console import Console
 
 from chi_edge.cli import cli
@@ -59,6 +61,11 @@ FAKE_DEVICE = {
 }
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHI_EDGE_CACHE_DIR", str(tmp_path / "cache"))
+
+
 def test_cli_help():
     runner = CliRunner()
     result = runner.invoke(cli, ["--help"])
@@ -351,3 +358,71 @@ def test_device_set_rejects_set_and_unset_of_same_property():
         assert result.exit_code != 0
         assert "Cannot both set and unset --contact-email" in result.output
         mock_adapter.patch.assert_not_called()
+
+
+def inventory(devices):
+    """A Doni adapter serving `devices`, by UUID, recording the paths fetched."""
+    mock_adapter = MagicMock()
+    mock_adapter.session.auth.get_cache_id.return_value = "creds"
+    mock_adapter.paths = []
+
+    def get(path):
+        mock_adapter.paths.append(path)
+        if path == "/v1/hardware/":
+            return MagicMock(**{"json.return_value": {"hardware": list(devices)}})
+        for device in devices:
+            if path == f"/v1/hardware/{device['uuid']}/":
+                return MagicMock(**{"json.return_value": device})
+        raise ksa_exc.NotFound()
+
+    mock_adapter.get.side_effect = get
+    return mock_adapter
+
+
+def test_device_name_index():
+    devices = [FAKE_DEVICE]
+    mock_adapter = inventory(devices)
+    by_uuid = f"/v1/hardware/{FAKE_DEVICE['uuid']}/"
+
+    runner = CliRunner()
+    with patch("chi_edge.cli.doni_client", return_value=mock_adapter):
+        for _ in range(2):
+            result = runner.invoke(cli, ["device", "show", "iot-rpi4-01"])
+            assert result.exit_code == 0, result.output
+        # The name is only looked up in the inventory once
+        assert mock_adapter.paths == ["/v1/hardware/", by_uuid, by_uuid]
+
+        # The device was registered again: the stale UUID is replaced
+        devices[0] = dict(FAKE_DEVICE, uuid="0c7c4a4e-3f0f-4a8e-9a47-6c1f1a1f7a10")
+        mock_adapter.paths.clear()
+        result = runner.invoke(cli, ["device", "show", "iot-rpi4-01"])
+        assert result.exit_code == 0, result.output
+        assert "0c7c4a4e" in result.output
+        assert mock_adapter.paths == [
+            by_uuid,
+            "/v1/hardware/",
+            f"/v1/hardware/{devices[0]['uuid']}/",
+        ]
+
+        result = runner.invoke(
+            cli, ["device", "delete", "iot-rpi4-01", "--yes-i-really-really-mean-it"]
+        )
+        assert result.exit_code == 0, result.output
+        devices.clear()
+        mock_adapter.paths.clear()
+        result = runner.invoke(cli, ["device", "show", "iot-rpi4-01"])
+        assert "not found" in result.output
+        assert mock_adapter.paths == ["/v1/hardware/"]
+
+
+def test_device_name_index_ttl(monkeypatch):
+    monkeypatch.setattr("chi_edge.device_index.DEVICE_INDEX_TTL", -1)
+    mock_adapter = inventory([FAKE_DEVICE])
+
+    runner = CliRunner()
+    with patch("chi_edge.cli.doni_client", return_value=mock_adapter):
+        for _ in range(2):
+            result = runner.invoke(cli, ["device", "sync", "iot-rpi4-01"])
+            assert result.exit_code == 0, result.output
+    assert mock_adapter.paths == ["/v1/hardware/", "/v1/hardware/"]
+    assert mock_adapter.post.call_count == 2
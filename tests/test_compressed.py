@@ -0,0 +1,89 @@
+import gzip
+import io
+import lzma
+import zipfile
+
+import pytest
+
+from chi_edge import compressed, image
+from tests.fatimage import make_disk_image
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHI_EDGE_CACHE_DIR", str(tmp_path / "cache"))
+
+
+def compress(raw, path):
+    if path.endswith(".gz"):
+        opener = gzip.open
+    elif path.endswith(".xz"):
+        opener = lzma.open
+    else:
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("balena.img", raw)
+        return
+    with opener(path, "wb") as f:
+        f.write(raw)
+
+
+def decompress(path):
+    with compressed.open_image_stream(path) as f:
+        return f.read()
+
+
+def write_config(boot):
+    config = boot.read_json("config.json")
+    config["uuid"] = "abc"
+    boot.write_json("config.json", config)
+
+
+@pytest.mark.parametrize(
+    "src,dst",
+    [("img.gz", "img.xz"), ("img.xz", "img"), ("zip", "img.gz"), ("img", "zip")],
+)
+def test_bake_stream(tmp_path, src, dst):
+    base = make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"})
+    raw = base.read_bytes()
+    if src != "img":
+        compress(raw, str(tmp_path / f"balena.{src}"))
+    source, target = str(tmp_path / f"balena.{src}"), str(tmp_path / f"device.{dst}")
+
+    part = compressed.bake_stream(source, target, write_config)
+    baked = decompress(target)
+    assert len(baked) == len(raw)
+    # Only the boot partition differs
+    end = part.offset + part.size
+    assert baked[: part.offset] == raw[: part.offset]
+    assert baked[end:] == raw[end:]
+    (tmp_path / "baked.img").write_bytes(baked)
+    config = image.read_config_json(str(tmp_path / "baked.img"), part, "config.json")
+    assert config == {"deviceType": "rpi", "uuid": "abc"}
+
+
+def test_bake_stream_limit(tmp_path):
+    base = make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"})
+    compress(base.read_bytes(), str(tmp_path / "balena.img.gz"))
+    target = tmp_path / "device.img.gz"
+    with pytest.raises(image.ImageError, match="first 8 MiB"):
+        compressed.bake_stream(
+            str(tmp_path / "balena.img.gz"), str(target), write_config, limit=8 << 20
+        )
+    assert not target.exists()
+
+    target.write_bytes(b"")
+    with pytest.raises(image.ImageError, match="already exists"):
+        compressed.bake_stream(
+            str(tmp_path / "balena.img.gz"), str(target), write_config
+        )
+
+
+def test_head_buffer_seek():
+    head = compressed._HeadBuffer(io.BytesIO(bytes(range(100))), limit=64)
+    assert head.seek(10) == 10
+    assert head.read(2) == b"\x0a\x0b"
+    assert head.seek(-4, io.SEEK_CUR) == 8
+    assert head.read(1) == b"\x08"
+    with pytest.raises(io.UnsupportedOperation):
+        head.seek(0, io.SEEK_END)
+    assert head.tell() == 9
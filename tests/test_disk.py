@@ -0,0 +1,196 @@
+import io
+import random
+
+import pytest
+
+from chi_edge.vendor.FATtools import Volume, disk
+from tests.fatimage import make_disk_image
+
+
+def ramdisk(size, **kwargs):
+    data = random.Random(size).randbytes(size)
+    return io.BytesIO(data), disk.disk(io.BytesIO(data), "ramdisk", **kwargs)
+
+
+@pytest.mark.parametrize("page_size,readahead", [(512, 0), (4096, 0), (4096, 4)])
+def test_disk_cache_matches_model(page_size, readahead):
+    model, d = ramdisk(256 << 10, page_size=page_size, cache_size=16 << 10)
+    d.cache_setup(readahead=readahead)
+    model = bytearray(model.getvalue())
+    rng = random.Random(page_size + readahead)
+    for _ in range(2000):
+        pos = rng.randrange(len(model))
+        length = rng.choice((1, 2, 4, 32, 512, 3000, 40000))
+        d.seek(pos)
+        if rng.random() < 0.4:
+            chunk = bytes([rng.randrange(256)]) * length
+            d.write(chunk)
+            # Writes stop at the disk's end
+            model[pos : pos + length] = chunk[: len(model) - pos]
+            assert d.tell() == min(pos + length, len(model))
+        else:
+            assert d.read(length) == model[pos : pos + length]
+    stats = d.cache_stats()
+    assert stats["evictions"] > 0
+    assert stats["pages"] <= stats["max_pages"] == (16 << 10) // page_size
+    d.close()
+    assert d._file.getvalue() == model
+
+
+def test_disk_cache_hits_and_readahead():
+    _, d = ramdisk(64 << 10, page_size=4096, readahead=3)
+    for pos in range(0, 32 << 10, 512):
+        d.seek(pos)
+        d.read(512)
+    stats = d.cache_stats()
+    # Once reads look sequential, misses load 4 pages at once
+    assert stats["misses"] == 3
+    assert stats["readaheads"] == 6
+    assert stats["hits"] == 64 - 3
+    # Multi-page reads are served from the cache
+    d.seek(100)
+    d.read(20000)
+    assert d.cache_stats()["misses"] == 3
+
+
+def test_disk_cache_direct_io():
+    model, d = ramdisk(1 << 20, page_size=4096, cache_size=64 << 10)
+    d.seek(8192)
+    d.write(bytes(512))
+    d.seek(0)
+    # Too large for the cache: not cached, but dirty pages are honoured
+    data = d.read(512 << 10)
+    assert data[8192 : 8192 + 512] == bytes(512)
+    assert data[:8192] == model.getvalue()[:8192]
+    assert d.cache_stats()["direct"] == 1
+    d.seek(4096)
+    d.write(b"\xaa" * (256 << 10))
+    assert d.cache_stats()["pages"] <= 16
+    d.flush()
+    assert d._file.getvalue()[4096 : 4096 + (256 << 10)] == b"\xaa" * (256 << 10)
+
+
+def test_volume_uses_cluster_pages(tmp_path):
+    path = make_disk_image(tmp_path / "boot.img", boot_size=16 << 20)
+    part = Volume.vopen(str(path), "rb", "partition0")
+    fs = Volume.openvolume(part)
+    assert part.disk.page_size == fs.boot.cluster
+    fs.close()
+    Volume.vclose(part)
+
+
+@pytest.mark.parametrize("ramdisk_mode", [False, True])
+def test_disk_flush_coalesces(tmp_path, ramdisk_mode):
+    data = random.Random(0).randbytes(1 << 20)
+    if ramdisk_mode:
+        d = disk.disk(io.BytesIO(data), "ramdisk", page_size=4096)
+    else:
+        (tmp_path / "disk.img").write_bytes(data)
+        d = disk.disk(str(tmp_path / "disk.img"), "r+b", page_size=4096)
+    model = bytearray(data)
+    # Two runs of dirty pages, touched out of order and a byte at a time
+    for pos in [70000, 4097, 20000, 65537, 8192, 12288, 69000]:
+        d.seek(pos)
+        d.write(b"\x01\x02")
+        model[pos : pos + 2] = b"\x01\x02"
+    d.flush()
+    assert d.cache_stats()["writes"] == 2
+    assert d.cache_stats()["dirty"] == 0
+    # The last page is clipped to the disk's end
+    d.seek(len(data) - 1)
+    d.write(b"\xff\xff")
+    model[-1] = 0xFF
+    d.close()
+    if ramdisk_mode:
+        assert d._file.getvalue() == model
+    else:
+        assert (tmp_path / "disk.img").read_bytes() == model
+
+
+def test_disk_fsync_on_close(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(disk.os, "fsync", synced.append)
+    (tmp_path / "disk.img").write_bytes(bytes(8192))
+    d = disk.disk(str(tmp_path / "disk.img"), "r+b")
+    d.close()
+    assert synced == []
+    d = disk.disk(str(tmp_path / "disk.img"), "r+b", fsync=True)
+    fd = d._fd
+    d.close()
+    assert synced == [fd]
+
+
+@pytest.mark.parametrize("fstype,size", [("FAT12", 4 << 20), ("FAT32", 40 << 20)])
+def test_mmap_disk_volume(tmp_path, fstype, size):
+    path = str(
+        make_disk_image(
+            tmp_path / "boot.img", fstype=fstype, boot_size=size, config={"a": 1}
+        )
+    )
+    part = Volume.vopen(path, "r+b", "partition0", mapped=True)
+    assert isinstance(part.disk, disk.mmap_disk)
+    fs = Volume.openvolume(part)
+    f = fs.open("config.json")
+    assert f.read() == b'{"a": 1}'
+    f.close()
+    f = fs.create("data.bin")
+    f.write(bytes(range(256)) * 100)
+    f.close()
+    fs.close()
+    Volume.vclose(part)
+
+    part = Volume.vopen(path, "rb", "partition0")
+    fs = Volume.openvolume(part)
+    f = fs.open("data.bin")
+    assert f.read() == bytes(range(256)) * 100
+    f.close()
+    fs.close()
+    Volume.vclose(part)
+
+
+def test_mmap_disk_ramdisk():
+    data = io.BytesIO(bytes(4096))
+    d = Volume.vopen(data, "r+b", "disk", mapped=True)
+    d.seek(4000)
+    d.write(b"\x01" * 200)
+    assert d.tell() == 4096
+    d.seek(3999)
+    view = d.read(10)
+    assert isinstance(view, memoryview) and view.readonly
+    assert view == b"\x00" + b"\x01" * 9
+    del view
+    Volume.vclose(d)
+    assert data.getvalue()[4000:] == b"\x01" * 96
+
+
+def test_overlay_disk_matches_model(tmp_path):
+    path = tmp_path / "base.img"
+    base = random.Random(1).randbytes(256 << 10)
+    path.write_bytes(base)
+    d = disk.overlay_disk(str(path), page_size=4096, cache_size=16 << 10)
+    model = bytearray(base)
+    rng = random.Random(2)
+    for _ in range(500):
+        pos = rng.randrange(len(model))
+        length = rng.choice((1, 100, 512, 3000, 40000))
+        d.seek(pos)
+        if rng.random() < 0.4:
+            chunk = rng.randbytes(length)
+            d.write(chunk)
+            model[pos : pos + length] = chunk[: len(model) - pos]
+        else:
+            assert d.read(length) == model[pos : pos + length]
+    assert d.cache_stats()["evictions"] > 0
+    d.close()
+    assert path.read_bytes() == base
+    extents = d.extents()
+    merged = bytearray(base)
+    for offset, data in extents:
+        assert offset % 512 == 0 and len(data) % 512 == 0
+        merged[offset : offset + len(data)] = data
+    assert merged == model
+    # Extents are disjoint, sorted and hold changed sectors only
+    assert all(a[0] + len(a[1]) < b[0] for a, b in zip(extents, extents[1:]))
+    for offset, data in extents:
+        assert data[:512] != base[offset : offset + 512]
+        assert data[-512:] != base[offset + len(data) - 512 : offset + len(data)]
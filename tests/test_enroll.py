@@ -0,0 +1,218 @@
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+from keystoneauth1 import noauth, session
+from rich.console import Console
+
+from chi_edge import enroll, image
+from chi_edge.cli import cli
+from tests.fatimage import make_disk_image
+
+
+class Inventory(BaseHTTPRequestHandler):
+    """A stand-in for the Doni hardware API, whose Balena worker enrolls a
+    device once the inventory was listed `ready_after` times."""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(("GET", self.path))
+        with server.lock:
+            for device in server.devices.values():
+                device["polls"] += 1
+                if device["polls"] >= server.ready_after:
+                    device["workers"][0]["state_details"] = {
+                        "device_api_key": f"key-{device['name']}",
+                        "fleet_id": 42,
+                    }
+        self.reply(200, {"hardware": list(server.devices.values())})
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server.requests.append(("POST", self.path))
+        device = dict(body, uuid=str(uuid.uuid4()), polls=0)
+        device["created_at"] = "2026-01-01T00:00:00+00:00"
+        device["workers"] = [{"worker_type": "balena", "state": "PENDING"}]
+        device["workers"][0]["state_details"] = {}
+        with server.lock:
+            server.devices[device["uuid"]] = device
+        self.reply(201, device)
+
+
+class Identity:
+    def __init__(self, names=()):
+        self.credentials = {name: SimpleNamespace(id=name, name=name) for name in names}
+        self.listed = 0
+        self.deleted = []
+
+    def application_credentials(self, user_id):
+        self.listed += 1
+        return list(self.credentials.values())
+
+    def create_application_credential(self, user_id, name):
+        credential = SimpleNamespace(id=f"id-{name}", name=name, secret="s")
+        self.credentials[name] = credential
+        return credential
+
+    def delete_application_credential(self, user_id, credential_id):
+        self.deleted.append(credential_id)
+        del self.credentials[credential_id]
+
+
+@pytest.fixture
+def inventory():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Inventory)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.devices = {}
+    server.ready_after = 3
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHI_EDGE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(enroll, "POLL_DELAY", 0.01)
+
+
+def write_manifest(tmp_path, devices, **defaults):
+    make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"})
+    defaults = dict({"machine_name": "raspberrypi5", "image": "balena.img"}, **defaults)
+    manifest = tmp_path / "devices.yaml"
+    manifest.write_text(json.dumps({"defaults": defaults, "devices": devices}))
+    return str(manifest)
+
+
+def invoke(server, identity, *args):
+    endpoint = f"http://127.0.0.1:{server.server_port}"
+
+    def connect(cloud):
+        doni = session.Session(auth=noauth.NoAuth(endpoint=endpoint))
+        return SimpleNamespace(session=doni, identity=identity, current_user_id="u")
+
+    with (
+        patch("chi_edge.cli.openstack") as mock_os,
+        patch("chi_edge.cli.console", Console(width=300)),
+    ):
+        mock_os.connect.side_effect = connect
+        return CliRunner().invoke(cli, ["device", "enroll", *args])
+
+
+def baked_config(path):
+    part = image.find_boot_partition(str(path), cache=False)
+    return image.read_config_json(str(path), part, "config.json")
+
+
+def test_enroll(tmp_path, inventory):
+    manifest = write_manifest(
+        tmp_path,
+        [
+            "pi-01",
+            {"name": "pi-02", "output": "custom.img", "boot_migrate_force": True},
+            {
+                "name": "pi-03",
+                "application_credential_id": "cred",
+                "application_credential_secret": "secret",
+            },
+        ],
+    )
+    identity = Identity(["unrelated"])
+    result = invoke(inventory, identity, "--manifest", manifest)
+    assert result.exit_code == 0, result.output
+
+    # Credentials are listed once, for the devices without one
+    assert identity.listed == 1
+    assert sorted(identity.credentials) == [
+        "chi-edge-pi-01",
+        "chi-edge-pi-02",
+        "unrelated",
+    ]
+    assert inventory.requests.count(("POST", "/v1/hardware/")) == 3
+    # All pending devices are polled with a single listing
+    listings = inventory.requests.count(("GET", "/v1/hardware/"))
+    assert listings == inventory.ready_after + 1
+
+    state = json.loads((tmp_path / "devices.state.json").read_text())
+    by_name = {d["name"]: d for d in inventory.devices.values()}
+    for name, output in [
+        ("pi-01", "pi-01.img"),
+        ("pi-02", "custom.img"),
+        ("pi-03", "pi-03.img"),
+    ]:
+        assert state[name]["stage"] == enroll.BAKED
+        config = baked_config(tmp_path / output)
+        assert config["deviceType"] == "rpi"
+        assert config["deviceApiKey"] == f"key-{name}"
+        assert config["uuid"] == by_name[name]["uuid"].replace("-", "")
+    assert by_name["pi-03"]["properties"]["application_credential_id"] == "cred"
+    assert baked_config(tmp_path / "custom.img")["installer"]["migrate"]["force"]
+
+
+def test_enroll_resume(tmp_path, inventory):
+    manifest = write_manifest(tmp_path, ["pi-01", "pi-02"])
+    identity = Identity()
+    inventory.ready_after = 1000
+    result = invoke(inventory, identity, "--manifest", manifest, "--timeout", "0")
+    assert result.exit_code != 0
+    assert "not ready after 0 s" in result.output
+    state = json.loads((tmp_path / "devices.state.json").read_text())
+    assert {d["stage"] for d in state.values()} == {enroll.REGISTERED}
+
+    inventory.ready_after = 0
+    inventory.requests.clear()
+    result = invoke(inventory, identity, "--manifest", manifest)
+    assert result.exit_code == 0, result.output
+    assert "Resuming" in result.output
+    assert ("POST", "/v1/hardware/") not in inventory.requests
+    assert identity.listed == 1
+    assert (tmp_path / "pi-01.img").exists() and (tmp_path / "pi-02.img").exists()
+
+
+def test_enroll_existing_credential(tmp_path, inventory):
+    manifest = write_manifest(tmp_path, ["pi-01", "pi-02"], image=None)
+    identity = Identity(["chi-edge-pi-02"])
+    result = invoke(inventory, identity, "--manifest", manifest)
+    assert result.exit_code != 0
+    assert "'chi-edge-pi-02' already exists" in result.output
+    assert [d["name"] for d in inventory.devices.values()] == ["pi-01"]
+
+    result = invoke(
+        inventory, identity, "--manifest", manifest, "--replace-credentials"
+    )
+    assert result.exit_code == 0, result.output
+    assert identity.deleted == ["chi-edge-pi-02"]
+    state = json.loads((tmp_path / "devices.state.json").read_text())
+    assert {d["stage"] for d in state.values()} == {enroll.READY}
+
+
+def test_load_manifest_errors(tmp_path):
+    for devices, message in [
+        (["pi-01", "pi-01"], "listed twice"),
+        (["Not_A_Name"], "RFC1123"),
+        ([{"name": "pi-01", "colour": "red"}], "Unknown key"),
+        (["pi-01", "pi-02"], "Several devices"),
+    ]:
+        manifest = write_manifest(tmp_path, devices, output="same.img")
+        with pytest.raises(enroll.ManifestError, match=message):
+            enroll.load_manifest(manifest)
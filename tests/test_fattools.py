@@ -0,0 +1,549 @@
+import random
+import struct
+
+import pytest
+
+from chi_edge.vendor.FATtools import (
+    FAT,
+    Volume,
+    crc32c,
+    exFAT,
+    fatalloc,
+    fatscan,
+    vhdxutils,
+)
+from tests.fatimage import make_disk_image
+
+
+def open_boot(path, mode="rb"):
+    part = Volume.vopen(str(path), mode, "partition0")
+    return part, Volume.openvolume(part)
+
+
+def close_boot(part, fs):
+    fs.close()
+    Volume.vclose(part)
+
+
+@pytest.mark.parametrize(
+    "fstype,size", [("FAT12", 4 << 20), ("FAT16", 16 << 20), ("FAT32", 40 << 20)]
+)
+def test_open_does_not_map_free_space(tmp_path, fstype, size):
+    path = make_disk_image(
+        tmp_path / "boot.img", fstype=fstype, boot_size=size, config={"a": 1}
+    )
+    part, fs = open_boot(path)
+    assert fs.fat.free_clusters_map is None
+    f = fs.open("config.json")
+    assert f.read() == b'{"a": 1}'
+    f.close()
+    assert fs.fat.free_clusters_map is None
+    close_boot(part, fs)
+
+
+def test_fat32_free_count_from_fsinfo(tmp_path):
+    path = make_disk_image(tmp_path / "boot.img", fstype="FAT32", boot_size=40 << 20)
+    part, fs = open_boot(path)
+    free, _ = fs.getdiskspace()
+    # FSInfo is trusted: the FAT is not scanned
+    assert fs.fat.free_clusters_map is None
+    assert free == fs.fat.map_free_space()[0]
+    close_boot(part, fs)
+
+
+def test_fat32_invalid_fsinfo_scans(tmp_path):
+    path = make_disk_image(tmp_path / "boot.img", fstype="FAT32", boot_size=40 << 20)
+    with open(path, "r+b") as f:
+        f.seek((1 << 20) + 512 + 0x1E8)
+        f.write(struct.pack("<I", 0xFFFFFFFF))
+    part, fs = open_boot(path)
+    free, _ = fs.getdiskspace()
+    assert fs.fat.free_clusters_map is not None
+    assert free == fs.fat.size - 1
+    close_boot(part, fs)
+
+
+def test_fat32_fsinfo_updated_on_write(tmp_path):
+    path = make_disk_image(tmp_path / "boot.img", fstype="FAT32", boot_size=40 << 20)
+    part, fs = open_boot(path, "r+b")
+    before, _ = fs.getdiskspace()
+    f = fs.create("big.bin")
+    f.write(bytes(fs.boot.cluster * 10))
+    f.close()
+    close_boot(part, fs)
+
+    part, fs = open_boot(path)
+    assert fs.getdiskspace()[0] == before - 10
+    assert fs.fat.map_free_space()[0] == before - 10
+    close_boot(part, fs)
+
+
+def naive_free_slots(s, bits):
+    free = set()
+    for slot in range(len(s) * 8 // bits):
+        if bits == 12:
+            value = int.from_bytes(s[slot * 3 // 2 : slot * 3 // 2 + 2], "little")
+            value = value >> 4 if slot % 2 else value & 0xFFF
+        else:
+            size = bits // 8
+            value = int.from_bytes(s[slot * size : slot * size + size], "little")
+        if not value:
+            free.add(slot)
+    return free
+
+
+def expand(runs):
+    return {i for start, length in runs for i in range(start, start + length)}
+
+
+@pytest.mark.parametrize("bits", [12, 16, 32])
+def test_fat_free_runs(bits):
+    rng = random.Random(bits)
+    size = bits // 4 * 3000
+    # Mostly allocated, mostly free and mixed pages
+    for density in (0.05, 0.5, 0.95):
+        s = bytes(
+            rng.randrange(1, 256) if rng.random() > density else 0 for _ in range(size)
+        )
+        runs = fatscan.fat_free_runs(s, bits, first=2)
+        assert expand(runs) == {i + 2 for i in naive_free_slots(s, bits)}
+        # Runs are maximal and ordered
+        assert all(a[0] + a[1] < b[0] for a, b in zip(runs, runs[1:]))
+
+
+def test_fat_free_runs_count():
+    assert fatscan.fat_free_runs(bytes(20), 16, first=2, count=4) == [(2, 4)]
+
+
+def test_bitmap_free_runs():
+    rng = random.Random(0)
+    for density in (0.05, 0.5, 0.95):
+        s = bytes(
+            rng.choice((0, 0xFF, rng.randrange(256)))
+            if rng.random() < density
+            else 0xFF
+            for _ in range(4000)
+        )
+        runs = fatscan.bitmap_free_runs(s, first=2)
+        expected = {i + 2 for i in range(len(s) * 8) if not s[i // 8] & (1 << (i % 8))}
+        assert expand(runs) == expected
+        assert all(a[0] + a[1] < b[0] for a, b in zip(runs, runs[1:]))
+    # Bits past the last cluster are ignored
+    assert fatscan.bitmap_free_runs(b"\x0f\x00", count=12) == [(4, 8)]
+
+
+def test_pack12():
+    rng = random.Random(12)
+    values = [rng.randrange(0x1000) for _ in range(1000)]
+    packed = fatscan.pack12(values)
+    assert len(packed) == 1500
+    for slot, value in enumerate(values):
+        word = int.from_bytes(packed[slot * 3 // 2 : slot * 3 // 2 + 2], "little")
+        assert (word >> 4 if slot % 2 else word & 0xFFF) == value
+
+
+@pytest.mark.parametrize(
+    "fstype,size", [("FAT12", 4 << 20), ("FAT16", 16 << 20), ("FAT32", 40 << 20)]
+)
+def test_map_free_space(tmp_path, fstype, size):
+    path = make_disk_image(tmp_path / "boot.img", fstype=fstype, boot_size=size)
+    part, fs = open_boot(path, "r+b")
+    fragment(fs)
+    fat = fs.fat
+    fat.map_free_space()
+    fat.stream.seek(fat.offset)
+    raw = fat.stream.read(((fat.size + 2) * fat.bits + 7) // 8)
+    expected = {i for i in naive_free_slots(raw, fat.bits) if 2 <= i <= fat.real_last}
+    assert expand(fat.free_clusters_map.items()) == expected
+    assert fat.free_clusters == len(expected)
+    close_boot(part, fs)
+
+
+def fragment(fs, files=20):
+    """Writes files, then deletes every other one and appends to the rest, so
+    that their chains get fragmented."""
+    for i in range(files):
+        f = fs.create(f"file{i}.bin")
+        f.write(bytes(fs.boot.cluster * (i + 1)))
+        f.close()
+    for i in range(0, files, 2):
+        fs.erase(f"file{i}.bin")
+    for i in range(1, files, 2):
+        f = fs.open(f"file{i}.bin")
+        f.seek(0, 2)
+        f.write(b"\xaa" * fs.boot.cluster * 3)
+        f.close()
+
+
+def test_free_extents():
+    runs = fatalloc.FreeExtents([(2, 3), (5, 2), (10, 8), (30, 4)])
+    # Adjacent runs are merged on build and on add
+    assert list(runs.items()) == [(2, 5), (10, 8), (30, 4)]
+    runs.add(18, 2)
+    runs.add(8, 2)
+    assert list(runs.items()) == [(2, 5), (8, 12), (30, 4)]
+    assert runs.largest() == (8, 12)
+    # Best fit picks the smallest run holding the request, else the largest
+    assert runs.find(4) == 30
+    assert runs.find(5) == 2
+    assert runs.find(50) == 8
+    # Next fit picks the first run holding it from a given cluster
+    assert runs.find(4, fit=fatalloc.NEXT_FIT, after=3) == 8
+    assert runs.find(4, fit=fatalloc.NEXT_FIT, after=31) == 2
+    # A run following a chain tail always wins
+    assert runs.find(4, prefer=2) == 2
+    assert runs.take(30, 3) == 3
+    assert runs.take(2, 8) == 5
+    assert list(runs.items()) == [(8, 12), (33, 1)]
+    assert runs.by_size == [(1, 33), (12, 8)]
+
+
+@pytest.mark.parametrize(
+    "fstype,size", [("FAT12", 4 << 20), ("FAT16", 16 << 20), ("FAT32", 40 << 20)]
+)
+def test_alloc_best_fit(tmp_path, fstype, size):
+    path = make_disk_image(tmp_path / "boot.img", fstype=fstype, boot_size=size)
+    part, fs = open_boot(path, "r+b")
+    fragment(fs)
+    fat = fs.fat
+    cluster = fs.boot.cluster
+    # Truncations and erasures are accounted
+    f = fs.open("file19.bin")
+    f.ftruncate(cluster, 1)
+    f.close()
+    fs.erase("file17.bin")
+    assert sorted(fat.free_clusters_map.items()) == list(fat.free_clusters_map.items())
+    assert sum(n for _, n in fat.free_clusters_map.items()) == fat.free_clusters
+    assert fat.free_clusters == fat.map_free_space()[0]
+
+    # The smallest hole holding a file is picked, and the file is contiguous
+    holes = sorted(n for i, n in fat.free_clusters_map.items() if n < 40)
+    f = fs.create("fit.bin")
+    f.write(bytes(holes[-1] * cluster))
+    f.close()
+    assert len(fs.open("fit.bin").File.runs) == 1
+    assert sorted(n for i, n in fat.free_clusters_map.items() if n < 40) == holes[:-1]
+    close_boot(part, fs)
+
+
+def read_fats(fat):
+    fat.stream.seek(fat.offset)
+    fat1 = fat.stream.read(fat.offset2 - fat.offset)
+    fat.stream.seek(fat.offset2)
+    return fat1, fat.stream.read(len(fat1))
+
+
+@pytest.mark.parametrize(
+    "fstype,size", [("FAT12", 4 << 20), ("FAT16", 16 << 20), ("FAT32", 40 << 20)]
+)
+def test_fat_mirrored_at_flush(tmp_path, fstype, size):
+    path = make_disk_image(tmp_path / "boot.img", fstype=fstype, boot_size=size)
+    part, fs = open_boot(path, "r+b")
+    fat = fs.fat
+    _, before = read_fats(fat)
+    fragment(fs)
+    fat1, fat2 = read_fats(fat)
+    # Only the first FAT is written until flushed
+    assert fat2 == before != fat1
+    assert fat.dirty_sectors
+    fs.flush()
+    assert not fat.dirty_sectors
+    fat1, fat2 = read_fats(fat)
+    assert fat1 == fat2
+    close_boot(part, fs)
+
+
+def test_fat12_mark_run(tmp_path, monkeypatch):
+    path = make_disk_image(tmp_path / "boot.img", fstype="FAT12", boot_size=4 << 20)
+    part, fs = open_boot(path, "r+b")
+    fat = fs.fat
+    head, _ = read_fats(fat)
+    expected = [fat[i] for i in range(fat.real_last + 1)]
+    writes = []
+    write = fat.stream.write
+    monkeypatch.setattr(fat.stream, "write", lambda s: writes.append(s) or write(s))
+    for start, count in ((3, 5), (10, 4), (21, 1), (30, 2), (fat.real_last - 2, 3)):
+        fat.mark_run(start, count)
+        expected[start : start + count] = list(range(start + 1, start + count)) + [
+            fat.last
+        ]
+    fat.mark_run(12, 3, True)
+    expected[12:15] = [0, 0, 0]
+    # Runs are packed and written at once
+    assert len(writes) == 6
+    fat.pages.clear()
+    assert [fat[i] for i in range(2, fat.real_last + 1)] == expected[2:]
+    # Media descriptor and padding past the last slot are kept
+    fat1, _ = read_fats(fat)
+    end = (fat.real_last + 1) * 3 // 2
+    assert fat1[:3] == head[:3] and fat1[end + 1 :] == head[end + 1 :]
+    close_boot(part, fs)
+
+
+@pytest.mark.parametrize("page_slots", [4096, 8])
+def test_fat12_updates_uncached_pages(tmp_path, page_slots):
+    path = make_disk_image(tmp_path / "boot.img", fstype="FAT12", boot_size=4 << 20)
+    part, fs = open_boot(path, "r+b")
+    fat = fs.fat
+    fat.page_slots = page_slots
+    # Each update starts from an empty cache, and reads its neighbour slots
+    for index, value in ((5, 0x123), (8, 0x456), (15, 0x789), (16, fat.last)):
+        fat.pages.clear()
+        fat[index] = value
+        assert fat[index] == value
+    for start, count in ((7, 4), (23, 4), (32, 3), (39, 9)):
+        fat.pages.clear()
+        fat.mark_run(start, count)
+        expected = list(range(start + 1, start + count)) + [fat.last]
+        assert [fat[i] for i in range(start, start + count)] == expected
+    cached = [fat[i] for i in range(2, 64)]
+    fat.pages.clear()
+    assert [fat[i] for i in range(2, 64)] == cached
+    close_boot(part, fs)
+
+
+@pytest.mark.parametrize(
+    "fstype,size", [("FAT12", 4 << 20), ("FAT16", 16 << 20), ("FAT32", 40 << 20)]
+)
+def test_fat_page_cache(tmp_path, fstype, size):
+    path = make_disk_image(tmp_path / "boot.img", fstype=fstype, boot_size=size)
+    part, fs = open_boot(path, "r+b")
+    fragment(fs)
+    fat = fs.fat
+    # A tiny cache, so that chains cross pages and pages get evicted
+    small = FAT.FAT(fat.stream, fat.offset, fat.size, fat.bits)
+    small.page_slots = 8
+    small.max_pages = 2
+
+    fat.stream.seek(fat.offset)
+    raw = fat.stream.read(((fat.size + 2) * fat.bits + 7) // 8)
+
+    def slot(i):
+        if not 2 <= i <= fat.real_last:
+            return fat.last
+        if fat.bits == 12:
+            value = int.from_bytes(raw[i * 3 // 2 : i * 3 // 2 + 2], "little")
+            return value >> 4 if i % 2 else value & 0xFFF
+        return int.from_bytes(
+            raw[i * fat.bits // 8 : (i + 1) * fat.bits // 8], "little"
+        )
+
+    for i in range(2, fat.real_last + 1):
+        assert small[i] == slot(i)
+    assert len(small.pages) == 2
+
+    for i in range(1, 20, 2):
+        start = fs.find(f"file{i}.bin").Start()
+        chain = [start]
+        while not fat.islast(slot(chain[-1])):
+            chain.append(slot(chain[-1]))
+        assert small.count(start) == (len(chain), chain[-1])
+        assert small.count_to(start, 3) == chain[3]
+        run = 1
+        while run < len(chain) and chain[run] == chain[run - 1] + 1:
+            run += 1
+        assert small.count_run(start) == (run, slot(chain[run - 1]))
+        assert small.count_run(start, 1) == (1, slot(start))
+
+    # Updates go through the cache
+    start = fs.find("file1.bin").Start()
+    small.count(start)
+    small[start] = small.last
+    assert small.count(start) == (1, start)
+    close_boot(part, fs)
+
+
+@pytest.mark.parametrize(
+    "fstype,size",
+    [("FAT12", 4 << 20), ("FAT16", 16 << 20), ("FAT32", 40 << 20), ("EXFAT", 16 << 20)],
+)
+def test_write_erase_reopen(tmp_path, fstype, size):
+    path = make_disk_image(tmp_path / "boot.img", fstype=fstype, boot_size=size)
+    part, fs = open_boot(path, "r+b")
+    cluster = fs.boot.cluster
+    free, _ = fs.getdiskspace()
+    root = fs.stream.size
+    rng = random.Random(size)
+    files = {}
+    for i in range(150):
+        # Reopen now and then, so that cached state is rebuilt from the disk
+        if i % 7 == 6:
+            close_boot(part, fs)
+            part, fs = open_boot(path, "r+b")
+        name = f"file{rng.randrange(24)}.bin"
+        if name in files and rng.random() < 0.4:
+            fs.erase(name)
+            del files[name]
+        else:
+            files[name] = rng.randbytes(rng.randrange(1, 12 * cluster))
+            f = fs.create(name)
+            f.write(files[name])
+            f.close()
+    close_boot(part, fs)
+
+    part, fs = open_boot(path, "r+b")
+    assert sorted(n for n in fs.listdir() if n.endswith(".bin")) == sorted(files)
+    for name, data in files.items():
+        f = fs.open(name)
+        assert f.read() == data
+        f.close()
+    # Every cluster but those of the grown root directory is freed again
+    for name in files:
+        fs.erase(name)
+    close_boot(part, fs)
+    part, fs = open_boot(path)
+    assert fs.getdiskspace()[0] == free - (fs.stream.size - root) // cluster
+    allocator = fs.boot.bitmap if fstype == "EXFAT" else fs.fat
+    assert allocator.map_free_space()[0] == fs.getdiskspace()[0]
+    close_boot(part, fs)
+
+
+def test_fat_copy_clusters(tmp_path):
+    path = make_disk_image(tmp_path / "boot.img", boot_size=16 << 20)
+    part, fs = open_boot(path, "r+b")
+    fragment(fs)
+    e = fs.find("file3.bin")
+    copy = FAT.fat_copy_clusters(fs.boot, fs.fat, e.Start())
+    assert copy != e.Start()
+    n = fs.fat.count(e.Start())[0]
+    assert fs.fat.count(copy)[0] == n
+    src = FAT.Chain(fs.boot, fs.fat, e.Start(), n * fs.boot.cluster)
+    dst = FAT.Chain(fs.boot, fs.fat, copy, n * fs.boot.cluster)
+    assert src.read(n * fs.boot.cluster) == dst.read(n * fs.boot.cluster)
+    close_boot(part, fs)
+
+
+@pytest.mark.parametrize(
+    "fstype,size",
+    [("FAT12", 4 << 20), ("FAT16", 16 << 20), ("FAT32", 40 << 20), ("EXFAT", 16 << 20)],
+)
+def test_chain_index(tmp_path, fstype, size):
+    path = make_disk_image(tmp_path / "boot.img", fstype=fstype, boot_size=size)
+    part, fs = open_boot(path, "r+b")
+    cluster = fs.boot.cluster
+    # Interleave writes to two files, so that both chains are fully fragmented
+    data = {name: bytearray() for name in ("a.bin", "b.bin")}
+    handles = {name: fs.create(name) for name in data}
+    for i in range(30):
+        for name, f in handles.items():
+            chunk = bytes([i + len(name) * ord(name[0]) & 0xFF]) * cluster
+            f.write(chunk)
+            data[name] += chunk
+    for f in handles.values():
+        f.close()
+
+    f = fs.open("a.bin")
+    chain = f.File
+    assert len(chain.runs) > 1
+    assert chain._lcns == list(chain.runs.keys())
+    assert chain._lens == list(chain.runs.values())
+    assert chain._vcns[-1] + chain._lens[-1] == len(data["a.bin"]) // cluster
+    rng = random.Random(0)
+    for _ in range(100):
+        pos = rng.randrange(len(data["a.bin"]))
+        length = rng.randrange(1, 3 * cluster)
+        f.seek(pos)
+        assert f.read(length) == data["a.bin"][pos : pos + length]
+
+    # Truncation drops the tail of the index
+    f.ftruncate(7 * cluster + 1, 1)
+    assert chain._lcns == list(chain.runs.keys())
+    assert chain._lens == list(chain.runs.values())
+    assert sum(chain._lens) == 8
+    f.seek(0)
+    assert f.read() == data["a.bin"][: 7 * cluster + 1]
+    f.close()
+    close_boot(part, fs)
+
+
+@pytest.mark.parametrize("fstype", ["FAT16", "EXFAT"])
+def test_dirtable_batched_reads(tmp_path, monkeypatch, fstype):
+    path = make_disk_image(tmp_path / "boot.img", fstype=fstype, boot_size=16 << 20)
+    part, fs = open_boot(path, "r+b")
+    d = fs.mkdir("many")
+    names = [f"a long file name {i:04d}.txt" for i in range(300)]
+    for name in names:
+        d.create(name).close()
+    for name in names[::3]:
+        d.erase(name)
+    close_boot(part, fs)
+    kept = [name for i, name in enumerate(names) if i % 3]
+
+    reads = []
+    read = FAT.Chain.read
+    monkeypatch.setattr(
+        FAT.Chain, "read", lambda self, size=-1: reads.append(size) or read(self, size)
+    )
+    # Blocks of a single cluster, so that slot groups straddle blocks
+    module = exFAT if fstype == "EXFAT" else FAT
+    monkeypatch.setattr(module.Dirtable, "block_size", 1)
+    part, fs = open_boot(path, "r+b")
+    d = fs.opendir("many")
+    assert [n for n in d.listdir() if n not in (".", "..")] == kept
+    assert d.find(kept[-1]).Name() == kept[-1]
+    assert d.find(names[0]) is None
+    # One read per cluster, rather than one per slot
+    clusters = d.stream.size // fs.boot.cluster
+    assert len(reads) <= 3 * (clusters + 1)
+
+    # Erased slots are reused
+    d.create("new.bin").close()
+    assert d.find("new.bin")._pos < d.find(kept[0])._pos
+    close_boot(part, fs)
+
+
+@pytest.mark.parametrize("fstype", ["FAT16", "EXFAT"])
+def test_paths_cache(tmp_path, fstype):
+    path = make_disk_image(tmp_path / "boot.img", fstype=fstype, boot_size=16 << 20)
+    part, fs = open_boot(path, "r+b")
+    fs.mkdir("a").mkdir("b").mkdir("c")
+    fs.opendir("a/b").create("x.bin").close()
+    before = fs.paths_cache_stats()
+
+    d = fs.opendir("A/B")
+    assert fs.opendir("a\\b") is d
+    for _ in range(5):
+        f = fs.open("a/b/x.bin")
+        f.close()
+    stats = fs.paths_cache_stats()
+    assert stats["hits"] - before["hits"] == 7
+    assert stats["misses"] == before["misses"]
+    start, e, table, _ = fs.boot.paths["./a/b"]
+    assert table is d and start == d.start == e.Start()
+
+    # Renaming a directory drops the paths through it
+    fs.opendir("a").rename("b", "renamed")
+    assert fs.opendir("a/b") is None
+    assert fs.opendir("a/renamed/c").start == fs.opendir("a/renamed").find("c").Start()
+    assert "./a/b/c" not in fs.boot.paths
+
+    # So do rmtree and erase
+    fs.rmtree("a")
+    assert fs.opendir("a/renamed") is None
+    assert fs.boot.paths == {}
+    fs.mkdir("a")
+    assert fs.opendir("a/renamed") is None
+    assert not [n for n in fs.opendir("a").listdir() if n not in (".", "..")]
+
+    # Closed tables are not handed out again
+    d = fs.opendir("a")
+    d.close()
+    assert fs.opendir("a") is not d
+    close_boot(part, fs)
+
+
+@pytest.mark.parametrize("backend", sorted(crc32c.backends))
+def test_crc32c_backends(tmp_path, backend, monkeypatch):
+    update = crc32c.backends[backend]
+    assert update(0xFFFFFFFF, b"123456789", 9) == 0xE3069283 ^ 0xFFFFFFFF
+    data = bytearray(random.Random(32).randbytes(1000))
+    for n in (0, 1, 7, 8, 9, 997):
+        expected = crc32c.crc_update_bytewise(0x12345678, data[3:], n)
+        assert update(0x12345678, memoryview(data)[3:], n) == expected
+    # VHDX headers and region tables are checksummed with the selected backend
+    monkeypatch.setattr(crc32c, "crc_update", update)
+    path = str(tmp_path / "disk.vhdx")
+    vhdxutils.mk_dynamic(path, 8 << 20)
+    image = vhdxutils.Image(path, "r+b")
+    assert image.header.isvalid()
+    image.close()
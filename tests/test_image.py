@@ -0,0 +1,145 @@
+import os
+
+import pytest
+
+from chi_edge import image
+from tests.fatimage import make_disk_image
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / "cache"
+    monkeypatch.setenv("CHI_EDGE_CACHE_DIR", str(path))
+    return path
+
+
+@pytest.mark.parametrize("gpt", [False, True])
+def test_list_partitions(tmp_path, gpt):
+    path = make_disk_image(tmp_path / "balena.img", gpt=gpt, extra_partitions=2)
+    parts = image.list_partitions(str(path))
+    assert [p.index for p in parts] == [0, 1, 2]
+    assert parts[0].offset == 1 << 20
+    assert parts[0].size == 16 << 20
+    assert parts[0].fstype == "FAT16"
+    assert parts[0].label == "resin-bo.ot"
+    assert parts[1].offset == parts[0].offset + parts[0].size
+    assert parts[1].label is None
+
+
+def test_list_partitions_logical(tmp_path):
+    path = make_disk_image(tmp_path / "balena.img", extra_partitions=4)
+    parts = image.list_partitions(str(path))
+    # Two primaries after the boot partition, then logical partitions
+    assert [p.index for p in parts] == [0, 1, 2, 4, 5]
+    assert parts[3].offset == parts[2].offset + parts[2].size + 512
+
+
+@pytest.mark.parametrize(
+    "fstype,size", [("FAT12", 4 << 20), ("FAT16", 16 << 20), ("FAT32", 40 << 20)]
+)
+def test_find_boot_partition(tmp_path, fstype, size):
+    path = make_disk_image(
+        tmp_path / "balena.img", fstype=fstype, label="flash-boot", boot_size=size
+    )
+    part = image.find_boot_partition(str(path))
+    assert part.index == 0
+    assert part.fstype == fstype
+    assert image.find_boot_partition_id(str(path)) == 0
+
+
+def test_find_boot_partition_missing(tmp_path):
+    path = make_disk_image(tmp_path / "other.img", label="data")
+    with pytest.raises(image.ImageError, match="Cannot find boot partition"):
+        image.find_boot_partition(str(path))
+
+
+def test_config_json_roundtrip(tmp_path):
+    path = str(make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"}))
+    part = image.find_boot_partition(path)
+    assert image.read_config_json(path, part, "config.json") == {"deviceType": "rpi"}
+
+    image.write_config_json(path, part, "config.json", {"uuid": "abc"})
+    assert image.read_config_json(path, part.index, "config.json") == {"uuid": "abc"}
+
+
+def test_boot_partition_session(tmp_path, monkeypatch):
+    path = str(make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"}))
+    mounts = []
+    vopen = image.Volume.vopen
+    monkeypatch.setattr(
+        image.Volume, "vopen", lambda *a, **kw: mounts.append(kw) or vopen(*a, **kw)
+    )
+    with image.BootPartition(path) as boot:
+        assert boot.partition.label == "resin-bo.ot"
+        config = boot.read_json("config.json")
+        config["uuid"] = "abc"
+        boot.write_json("config.json", config)
+        assert boot.read_json("config.json") == {"deviceType": "rpi", "uuid": "abc"}
+    # One partition table scan, then one mount
+    assert len(mounts) == 2 and mounts[1]["what"] == "partition"
+    assert image.read_config_json(path, 0, "config.json") == config
+
+
+def test_boot_partition_cache(tmp_path, cache_dir, monkeypatch):
+    path = str(make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"}))
+    part = image.find_boot_partition(path)
+    assert (cache_dir / image.PARTITION_CACHE_FILE).exists()
+
+    scans = []
+    monkeypatch.setattr(image, "list_partitions", lambda img: scans.append(img) or [])
+    assert image.find_boot_partition(path) == part
+    assert not scans
+    # Writing through a session keeps the new fingerprint known
+    with image.BootPartition(path) as boot:
+        boot.write_json("config.json", {"uuid": "abc"})
+    assert image.find_boot_partition(path) == part
+    assert not scans
+
+    with pytest.raises(image.ImageError):
+        image.find_boot_partition(path, cache=False)
+    image.clear_partition_cache()
+    with pytest.raises(image.ImageError):
+        image.find_boot_partition(path)
+    assert scans == [path, path]
+
+
+def test_boot_partition_cache_fingerprint(tmp_path):
+    path = make_disk_image(tmp_path / "balena.img")
+    key = image.image_fingerprint(str(path))
+    data = bytearray(path.read_bytes())
+    data[446 + 8] ^= 1  # moves the first partition
+    path.write_bytes(data)
+    os.utime(path, ns=(0, int(key.split("-")[1])))
+    assert image.image_fingerprint(str(path)) != key
+
+
+@pytest.mark.parametrize("copy_file_range", [True, False])
+def test_clone_image_sparse(tmp_path, monkeypatch, copy_file_range):
+    src = tmp_path / "base.img"
+    with open(src, "wb") as f:
+        f.truncate(64 << 20)
+        for offset in (0, 5 << 20, (64 << 20) - 4096):
+            f.seek(offset)
+            f.write(os.urandom(4096))
+    monkeypatch.setattr(image, "_reflink", lambda src_fd, dst_fd: False)
+    if not copy_file_range:
+        monkeypatch.delattr(os, "copy_file_range", raising=False)
+    dst = tmp_path / "device.img"
+    assert image.clone_image(str(src), str(dst)) == "sparse"
+    assert dst.read_bytes() == src.read_bytes()
+    assert dst.stat().st_blocks * 512 <= max(src.stat().st_blocks * 512, 1 << 20)
+
+    with pytest.raises(FileExistsError):
+        image.clone_image(str(src), str(dst))
+    assert dst.exists()
+
+
+def test_clone_image_keeps_base(tmp_path):
+    base = str(make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"}))
+    part = image.find_boot_partition(base)
+    clone = str(tmp_path / "device.img")
+    assert image.clone_image(base, clone) in ("reflink", "sparse")
+    with image.BootPartition(clone, part) as boot:
+        boot.write_json("config.json", {"uuid": "abc"})
+    assert image.read_config_json(base, part, "config.json") == {"deviceType": "rpi"}
+    assert image.read_config_json(clone, part, "config.json") == {"uuid": "abc"}
@@ -1,3 +1,16 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+# Cumulative time, in microseconds, `import chi_edge.cli` must stay under
+CLI_IMPORT_BUDGET_US = 150_000
+# Only loaded by the commands using them
+HEAVY_MODULES = ("openstack", "keystoneauth1", "rich", "yaml")
+
+
 def test_package_imports():
     from chi_edge import SUPPORTED_MACHINE_NAMES, LOCAL_EGRESS
 
@@ -9,3 +22,31 @@ def test_utils_import():
     from chi_edge.utils import validate_rfc1123_name
 
     assert callable(validate_rfc1123_name)
+
+
+def cli_import_times():
+    """Cumulative import times of the modules loaded by `import chi_edge.cli`
+    in a fresh interpreter, as reported by `-X importtime`."""
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).parents[1]))
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import chi_edge.cli"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, _, cumulative, name = line.replace("|", ":").split(":", 3)
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_cold_import():
+    pytest.importorskip("click")
+    times = cli_import_times()
+    assert not [name for name in times if name.split(".")[0] in HEAVY_MODULES]
+    assert times["chi_edge.cli"] < CLI_IMPORT_BUDGET_US
@@ -0,0 +1,74 @@
+import io
+
+import pytest
+
+from chi_edge import image, overlay
+from tests.fatimage import make_disk_image
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHI_EDGE_CACHE_DIR", str(tmp_path / "cache"))
+
+
+def bake_overlay(base, path, config):
+    part = image.find_boot_partition(base)
+    d = overlay.open_overlay_disk(base)
+    with image.BootPartition(d, part) as boot:
+        boot.write_json("config.json", config)
+    overlay.write_overlay(path, base, d.extents())
+    return part
+
+
+def test_overlay_roundtrip(tmp_path):
+    base = str(make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"}))
+    pristine = open(base, "rb").read()
+    path = str(tmp_path / "device.ovl")
+    part = bake_overlay(base, path, {"uuid": "abc"})
+    assert open(base, "rb").read() == pristine
+
+    patch = overlay.read_overlay(path)
+    assert patch.size == len(pristine)
+    assert sum(len(data) for _, data in patch.extents) <= 16 << 10
+
+    target = str(tmp_path / "device.img")
+    overlay.apply_overlay(base, patch, target)
+    assert image.read_config_json(target, part, "config.json") == {"uuid": "abc"}
+    out = io.BytesIO()
+    overlay.stream_overlay(base, patch, out)
+    assert out.getvalue() == open(target, "rb").read()
+
+
+def test_overlay_wrong_base(tmp_path):
+    base = str(make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"}))
+    other = str(make_disk_image(tmp_path / "other.img", config={"deviceType": "x"}))
+    path = str(tmp_path / "device.ovl")
+    bake_overlay(base, path, {"uuid": "abc"})
+    patch = overlay.read_overlay(path)
+    with pytest.raises(image.ImageError):
+        overlay.apply_overlay(other, patch, str(tmp_path / "device.img"))
+    assert not (tmp_path / "device.img").exists()
+    out = io.BytesIO()
+    with pytest.raises(image.ImageError):
+        overlay.stream_overlay(other, patch, out)
+    assert not out.getvalue()
+
+    (tmp_path / "bad.ovl").write_bytes(open(path, "rb").read()[:-1])
+    with pytest.raises(image.ImageError, match="truncated"):
+        overlay.read_overlay(str(tmp_path / "bad.ovl"))
+
+
+def test_overlay_stream_same_size_wrong_base(tmp_path):
+    base = str(make_disk_image(tmp_path / "balena.img", config={"deviceType": "rpi"}))
+    path = str(tmp_path / "device.ovl")
+    bake_overlay(base, path, {"uuid": "abc"})
+    patch = overlay.read_overlay(path)
+    # Same size, different contents: only the digest tells them apart
+    other = tmp_path / "other.img"
+    data = bytearray(open(base, "rb").read())
+    data[-1] ^= 0xFF
+    other.write_bytes(data)
+    out = io.BytesIO()
+    with pytest.raises(image.ImageError, match="not the base image"):
+        overlay.stream_overlay(str(other), patch, out)
+    assert out.getvalue() == b""
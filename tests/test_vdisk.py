@@ -0,0 +1,131 @@
+import io
+import random
+import struct
+
+import pytest
+
+from chi_edge.vendor.FATtools import battable, vdiutils, vhdutils, vhdxutils, vmdkutils
+
+FORMATS = {"vhd": vhdutils, "vhdx": vhdxutils, "vdi": vdiutils, "vmdk": vmdkutils}
+
+
+class CountingIO(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = []
+        self.writes = []
+
+    def read(self, size=-1):
+        self.reads.append(self.tell())
+        return super().read(size)
+
+    def write(self, s):
+        self.writes.append((self.tell(), bytes(s)))
+        return super().write(s)
+
+
+class BigTable(battable.Table):
+    fmt = ">I"
+    window = 16
+
+
+def test_bat_table():
+    entries = list(range(100, 200))
+    stream = CountingIO(bytes(64) + struct.pack(">100I", *entries) + bytes(400))
+    bat = BigTable(stream, 64, 100, 512)
+    bat.mirrors = (464,)
+    assert [bat[i] for i in range(100)] == entries
+    assert bat[-1] == 199
+    # One read per window of entries
+    assert len(stream.reads) == 7
+    with pytest.raises(BaseException):
+        bat[100]
+
+    stream.seek(3)
+    for i in (5, 6, 7, 40):
+        bat[i] = i
+    assert not stream.writes
+    bat.flush()
+    bat.flush()
+    # Runs of entries are written once to the table and to its copy
+    assert stream.writes == [
+        (64 + 20, struct.pack(">3I", 5, 6, 7)),
+        (464 + 20, struct.pack(">3I", 5, 6, 7)),
+        (64 + 160, struct.pack(">I", 40)),
+        (464 + 160, struct.pack(">I", 40)),
+    ]
+    assert stream.tell() == 3
+
+
+@pytest.mark.parametrize("fmt", sorted(FORMATS))
+def test_dynamic_image_bat(tmp_path, fmt):
+    mod = FORMATS[fmt]
+    path = str(tmp_path / f"disk.{fmt}")
+    mod.mk_dynamic(path, 64 << 20)
+    rng = random.Random(fmt)
+    model = {}
+    image = mod.Image(path, "r+b")
+    for _ in range(20):
+        pos = rng.randrange((64 << 20) - 4096) // 512 * 512
+        model[pos] = rng.randbytes(4096)
+        image.seek(pos)
+        image.write(model[pos])
+    image.close()
+
+    image = mod.Image(path, "rb")
+    for pos, data in model.items():
+        image.seek(pos)
+        assert image.read(4096) == data
+    image.close()
+
+
+def test_bit_runs():
+    rng = random.Random(3)
+    for lsb in (True, False):
+        for _ in range(200):
+            bmp = bytearray(
+                rng.choice((0, 0xFF, rng.randrange(256))) for _ in range(16)
+            )
+            first = rng.randrange(128)
+            count = rng.randint(1, 128 - first)
+            shift = (lambda p: p & 7) if lsb else (lambda p: 7 - (p & 7))
+            bits = [bmp[p >> 3] >> shift(p) & 1 for p in range(first, first + count)]
+            runs = list(battable.bit_runs(bmp, first, count, lsb))
+            assert [bit for bit, n in runs for _ in range(n)] == bits
+            assert all(a[0] != b[0] for a, b in zip(runs, runs[1:]))
+
+
+@pytest.mark.parametrize("fmt", sorted(FORMATS))
+def test_differencing_image_read(tmp_path, monkeypatch, fmt):
+    monkeypatch.chdir(tmp_path)
+    mod = FORMATS[fmt]
+    mod.mk_dynamic(f"base.{fmt}", 16 << 20)
+    rng = random.Random(fmt)
+    model = bytearray(16 << 20)
+
+    def scribble(name, count, size):
+        image = mod.Image(name, "r+b")
+        for _ in range(count):
+            pos = rng.randrange(len(model) - size)
+            data = rng.randbytes(rng.randint(1, size))
+            model[pos : pos + len(data)] = data
+            image.seek(pos)
+            image.write(data)
+        image.close()
+
+    scribble(f"base.{fmt}", 8, 1 << 20)
+    mod.mk_diff(f"child.{fmt}", f"base.{fmt}")
+    scribble(f"child.{fmt}", 64, 3000)
+
+    image = mod.Image(f"child.{fmt}", "rb")
+    assert image.read() == model
+    for _ in range(50):
+        pos = rng.randrange(len(model))
+        buf = bytearray(rng.randint(1, 1 << 20))
+        image.seek(pos)
+        n = image.readinto(memoryview(buf))
+        assert n == min(len(buf), len(model) - pos)
+        assert buf[:n] == model[pos : pos + n]
+        assert image.tell() == pos + n
+    image.close()
+    image.Parent.close()